@@ -1,24 +1,84 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException, Query
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-import requests
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import functools
+import time
 import uuid
 import os
-import subprocess
-import concurrent.futures
+import json
+from typing import Literal
+
+from detector.admission import AdmissionController, AdmissionError, ClientLimitExceeded
+from detector.batching import MicroBatcher
+from detector.budget import BudgetPlanner
+from detector.cache import ResultCache
+from detector.fetch import FetchError, ImageFetcher, ImageTooLargeError
+from detector.jobs import JobManager, JobQueueFull
+from detector.metrics import Metrics
+from detector.images import decode_image
+from detector.model import YoloDetector, onnx_model, serving_checkpoint
+from detector.registry import ModelRegistry, UnknownModelError, parse_models
+from detector.workers import InferencePool
 
 # Constants
 IMAGE_DIR = "downloads"
 RESULTS_DIR = "results"
+DEBUG_PERSIST = os.getenv("DEBUG_PERSIST", "false").lower() == "true"  # keep inputs/results on disk
 DETECTION_TIMEOUT = 30  # seconds
-YOLO_DETECT_SCRIPT = "utils/yolov9/detect.py"
 YOLO_WEIGHTS = "utils/yolov9/yolov9-e-converted.pt"
+YOLO_MODELS = parse_models(os.getenv("YOLO_MODELS", f"yolov9-e={YOLO_WEIGHTS}"))  # name=weights,... (any DetectMultiBackend format)
+YOLO_DEFAULT_MODEL = os.getenv("YOLO_DEFAULT_MODEL") or next(iter(YOLO_MODELS))  # used when a request names no model
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", 0))  # evict idle models beyond this, 0 is unlimited
+YOLO_IMG_SIZE = 640
+BUDGET_IMG_SIZES = [int(s) for s in os.getenv("BUDGET_IMG_SIZES", "640,512,384,320").split(",") if s]  # budget_ms candidates
+YOLO_CONF_THRES = 0.2
+NMS_METHOD = os.getenv("NMS_METHOD", "nms")  # nms, cluster, cluster-merge (weighted boxes) or matrix
+YOLO_DEVICE = os.getenv("YOLO_DEVICE", "")  # "" picks CUDA when available, else CPU
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 8))  # images per forward pass
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", 10))  # max wait to fill a batch
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 0))  # model processes, 0 runs it in-process
+THREADS_PER_WORKER = int(os.getenv("THREADS_PER_WORKER", 0))  # torch threads per worker, 0 splits all cores
+WARMUP_BATCH_SIZES = [int(s) for s in os.getenv("WARMUP_BATCH_SIZES", f"1,{BATCH_MAX_SIZE}").split(",") if s]  # per size
+SERVING_CHECKPOINT_DIR = os.getenv("SERVING_CHECKPOINT_DIR") or None  # fused, memory-mapped .pt copies of the weights
+INFERENCE_OPTIMIZE = os.getenv("INFERENCE_OPTIMIZE") or None  # channels_last, jit or compile, unset runs eager
+OPTIMIZE_CACHE_DIR = os.getenv("OPTIMIZE_CACHE_DIR") or None  # optimized models kept across restarts
+ONNX_MODELS = [s.strip() for s in os.getenv("ONNX_MODELS", "").split(",") if s.strip()]  # served by ONNX Runtime
+ONNX_EXPORT_DIR = os.getenv("ONNX_EXPORT_DIR", "onnx")  # ONNX exports of the ONNX_MODELS .pt weights
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", 0))  # ONNX Runtime threads per operator, 0 uses all cores
+ORT_INTER_OP_THREADS = int(os.getenv("ORT_INTER_OP_THREADS", 0))  # ONNX Runtime operators run in parallel, 0 sequential
+FETCH_MAX_CONNECTIONS = int(os.getenv("FETCH_MAX_CONNECTIONS", 100))  # pooled connections, all hosts
+FETCH_MAX_PER_HOST = int(os.getenv("FETCH_MAX_PER_HOST", 10))  # concurrent downloads per host
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", 10))  # seconds
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 20 * 1024 * 1024))  # downloads and uploads
+BATCH_REQUEST_MAX_IMAGES = int(os.getenv("BATCH_REQUEST_MAX_IMAGES", 1000))  # images per /detection/batch call
+BATCH_REQUEST_CONCURRENCY = int(os.getenv("BATCH_REQUEST_CONCURRENCY", 32))  # in-flight images per batch call
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 100))  # queued async jobs before POST /detection/jobs gets a 503
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 8))  # async jobs processed at the same time
+JOB_EXPIRY = float(os.getenv("JOB_EXPIRY", 60))  # seconds a job may wait in the queue before it is dropped
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 600))  # seconds finished job results stay available
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", 0.2))  # tiled mode: overlap between tiles (fraction of tile size)
+TILE_BATCH_SIZE = int(os.getenv("TILE_BATCH_SIZE", 8))  # tiled mode: tiles per forward pass
+TILE_MERGE = os.getenv("TILE_MERGE", "nms")  # tiled mode: merge across tile seams, nms or wbf
+TILE_FULL_IMG_SIZE = int(os.getenv("TILE_FULL_IMG_SIZE", 0))  # tiled mode: extra full-image pass size, 0 disables
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", 32))  # detections decoded/inferred at once, 0 disables
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", 64))  # interactive requests waiting for a slot
+ADMISSION_BULK_QUEUE_SIZE = int(os.getenv("ADMISSION_BULK_QUEUE_SIZE", 256))  # bulk requests waiting for a slot
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 10))  # seconds an interactive request may wait
+CLIENT_MAX_CONCURRENCY = int(os.getenv("CLIENT_MAX_CONCURRENCY", 16))  # requests in progress per client, 0 unlimited
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 1024))  # in-memory results, 0 disables
+CACHE_TTL = float(os.getenv("CACHE_TTL", 300))  # seconds
+CACHE_DIR = os.getenv("CACHE_DIR") or None  # optional on-disk tier
+CACHE_PERCEPTUAL = os.getenv("CACHE_PERCEPTUAL", "false").lower() == "true"  # match re-encoded near-duplicates
 
-# Prepare folders
-os.makedirs(IMAGE_DIR, exist_ok=True)
-os.makedirs(RESULTS_DIR, exist_ok=True)
-
-app = FastAPI()
+# Prepare folders (only used for debugging)
+if DEBUG_PERSIST:
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
 
 # COCO class mapping (subset of interest)
 COCO_CLASSES = {
@@ -29,6 +89,119 @@ COCO_CLASSES = {
     # 7: "truck"
 }
 
+
+def load_model(app: FastAPI, name: str, weights: str):
+    # Build one registry model: its detector (in-process or worker pool) behind its own micro-batcher
+    if name in ONNX_MODELS:
+        # Served by ONNX Runtime, so the same weights can be A/B tested against PyTorch under two names
+        weights = onnx_model(weights, ONNX_EXPORT_DIR)
+    elif SERVING_CHECKPOINT_DIR:
+        # Workers map the same fused file, so its pages are shared instead of copied per process
+        weights = serving_checkpoint(weights, SERVING_CHECKPOINT_DIR)
+    detector_kwargs = dict(
+        weights=weights,
+        imgsz=YOLO_IMG_SIZE,
+        device=YOLO_DEVICE,
+        conf_thres=YOLO_CONF_THRES,
+        nms=NMS_METHOD,
+        optimize=INFERENCE_OPTIMIZE,
+        optimize_cache=OPTIMIZE_CACHE_DIR,
+        ort_threads=(ORT_INTRA_OP_THREADS, ORT_INTER_OP_THREADS),
+        classes=list(COCO_CLASSES),
+        tile_overlap=TILE_OVERLAP,
+        tile_batch_size=TILE_BATCH_SIZE,
+        tile_merge=TILE_MERGE,
+        tile_full_imgsz=TILE_FULL_IMG_SIZE,
+        profile_sizes=BUDGET_IMG_SIZES,
+        warmup_batch_sizes=WARMUP_BATCH_SIZES,
+    )
+    if INFERENCE_WORKERS > 0:
+        # One model copy per worker process, images handed over through shared memory
+        detector = InferencePool(detector_kwargs, workers=INFERENCE_WORKERS, threads_per_worker=THREADS_PER_WORKER)
+    else:
+        detector = YoloDetector(**detector_kwargs)
+    # Concurrent requests share forward passes through the batcher
+    batcher = MicroBatcher(
+        detector,
+        max_batch_size=BATCH_MAX_SIZE,
+        max_wait_ms=BATCH_WINDOW_MS,
+        num_threads=max(1, INFERENCE_WORKERS),
+        metrics=app.state.metrics,
+    )
+    batcher.start()
+    return batcher, detector.nbytes
+
+
+def unload_model(batcher: MicroBatcher):
+    batcher.stop()
+    if isinstance(batcher.detector, InferencePool):
+        batcher.detector.close()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Per-stage latencies, batch sizes and queue state, scraped from /metrics
+    app.state.metrics = Metrics()
+    if set(ONNX_MODELS) - set(YOLO_MODELS):
+        raise ValueError(f"ONNX_MODELS {sorted(set(ONNX_MODELS) - set(YOLO_MODELS))} are not in YOLO_MODELS")
+    # Named models, loaded on first use; the default one is loaded now and kept resident while in use
+    app.state.models = ModelRegistry(
+        YOLO_MODELS,
+        default=YOLO_DEFAULT_MODEL,
+        load=functools.partial(load_model, app),
+        unload=unload_model,
+        memory_budget=int(MODEL_MEMORY_BUDGET_MB * 2**20),
+    )
+    await app.state.models.preload()
+    # Model and image size for requests with a latency budget
+    app.state.planner = BudgetPlanner(app.state.models)
+    # Bounded admission with interactive/bulk lanes and per-client limits
+    app.state.admission = AdmissionController(
+        max_active=ADMISSION_MAX_ACTIVE,
+        max_queued={"interactive": ADMISSION_QUEUE_SIZE, "bulk": ADMISSION_BULK_QUEUE_SIZE},
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        client_limit=CLIENT_MAX_CONCURRENCY,
+    )
+    # Image downloads share one connection pool
+    app.state.fetcher = ImageFetcher(
+        max_connections=FETCH_MAX_CONNECTIONS,
+        max_per_host=FETCH_MAX_PER_HOST,
+        max_bytes=MAX_IMAGE_BYTES,
+        timeout=FETCH_TIMEOUT,
+    )
+    # Results for repeated images, keyed by content, model and settings
+    app.state.cache = ResultCache(
+        namespace=f"{YOLO_IMG_SIZE}|{YOLO_CONF_THRES}|{NMS_METHOD}|{sorted(COCO_CLASSES)}",
+        max_entries=CACHE_MAX_ENTRIES,
+        ttl=CACHE_TTL,
+        disk_dir=CACHE_DIR,
+        perceptual=CACHE_PERCEPTUAL,
+    )
+    # Background jobs, also holding results of requests that exceeded DETECTION_TIMEOUT
+    app.state.jobs = JobManager(
+        functools.partial(detect_content, app),
+        max_queued=JOB_QUEUE_SIZE,
+        concurrency=JOB_CONCURRENCY,
+        expiry=JOB_EXPIRY,
+        retention=JOB_RETENTION,
+    )
+    await app.state.jobs.start()
+    register_metrics(app)
+    yield
+    await app.state.jobs.stop()
+    await app.state.fetcher.aclose()
+    await app.state.models.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(AdmissionError)
+async def admission_error_handler(request: Request, exc: AdmissionError):
+    # 429 when the client itself sends too much, 503 when the service as a whole is saturated
+    status_code = 429 if isinstance(exc, ClientLimitExceeded) else 503
+    return JSONResponse(status_code=status_code, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
 # Response models
 class BBox(BaseModel):
     x_center: float
@@ -40,95 +213,405 @@ class DetectedObject(BaseModel):
     class_: str
     bbox: BBox
 
+
+class DetectionSettings(BaseModel):
+    model: str
+    imgsz: int
+    tiled: bool = False
+    budget_ms: float | None = None  # latency budget the settings were chosen for
+    predicted_ms: float | None = None  # predicted detection latency with these settings
+
 class DetectionResult(BaseModel):
     message: str
     detections: dict[str, list[DetectedObject]] | None = None
+    settings: DetectionSettings | None = None  # model and inference size that produced the detections
+    job_id: str | None = None  # set when the result is still being computed, poll /detection/jobs/{job_id}
 
 
-def run_detection(image_path: str, result_name: str) -> list[dict]:
-    output_dir = os.path.join(RESULTS_DIR, result_name)
-    labels_dir = os.path.join(output_dir, "labels")
-    image_name = os.path.splitext(os.path.basename(image_path))[0]
-    label_file = os.path.join(labels_dir, f"{image_name}.txt")
+class JobStatus(BaseModel):
+    job_id: str
+    status: str  # queued, running, completed, failed or expired
+    result: DetectionResult | None = None
+    error: str | None = None
 
-    command = [
-        "python", YOLO_DETECT_SCRIPT,
-        "--weights", YOLO_WEIGHTS,
-        "--source", image_path,
-        "--save-txt",
-        "--project", RESULTS_DIR,
-        "--name", result_name,
-        "--exist-ok",
-        "--conf", "0.2"
-    ]
 
-    try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        print("YOLOv9 stdout:", result.stdout)
-        print("YOLOv9 stderr:", result.stderr)
-    except subprocess.CalledProcessError as e:
-        print("Detection error output:", e.stderr)
-        raise RuntimeError(f"Detection failed: {e.stderr}")
+class BatchDetectionRequest(BaseModel):
+    image_urls: list[str]
 
-    if not os.path.exists(label_file):
-        print("No label file found, returning empty results.")
-        return []
 
-    detections = []
-    with open(label_file, "r") as f:
-        for line in f:
-            parts = line.strip().split()
-            if len(parts) < 5:
-                continue
+class BatchDetectionResult(DetectionResult):
+    index: int  # position of the image in the request
+    source: str  # image URL or uploaded file name
+
+
+def register_metrics(app: FastAPI):
+    # Live values read only when /metrics is scraped
+    state, collect = app.state, app.state.metrics.collect
+    collect("detection_batcher_queue_depth", "gauge", "Images waiting for a forward pass.",
+            lambda: sum(batcher.qsize() for batcher in state.models.loaded().values()))
+    collect("detection_models_loaded", "gauge", "Registry models currently loaded.", lambda: len(state.models.loaded()))
+    collect("detection_models_memory_bytes", "gauge", "Memory held by loaded models.",
+            lambda: state.models.stats()["memory_used"])
+    collect("detection_admission_active", "gauge", "Detections holding an admission slot.", lambda: state.admission.active)
+    collect("detection_admission_queued", "gauge", "Requests waiting for an admission slot by lane.",
+            lambda: state.admission.stats()["queued"], "lane")
+    collect("detection_admission_admitted_total", "counter", "Admitted detections by lane.",
+            lambda: state.admission.admitted, "lane")
+    collect("detection_admission_rejected_total", "counter", "Rejected requests by reason.",
+            lambda: state.admission.rejected, "reason")
+    collect("detection_jobs_queue_depth", "gauge", "Async jobs waiting to start.", lambda: state.jobs.stats()["queued"])
+    collect("detection_jobs", "gauge", "Tracked async jobs by status.", lambda: state.jobs.stats()["jobs"], "status")
+    collect("detection_cache_lookups_total", "counter", "Result cache lookups by outcome.", lambda: {
+        "memory_hit": state.cache.hits, "disk_hit": state.cache.disk_hits, "miss": state.cache.misses,
+    }, "result")
+    collect("detection_cache_hit_ratio", "gauge", "Share of cache lookups served from the cache.",
+            lambda: state.cache.stats()["hit_rate"])
+    collect("detection_cache_entries", "gauge", "Results held in the in-memory cache.", lambda: state.cache.stats()["entries"])
 
-            class_id = int(parts[0])
-            x_center, y_center, width, height = map(float, parts[1:5])
-
-            label = COCO_CLASSES.get(class_id)
-            if label:
-                detections.append({
-                    "class_": label,
-                    "bbox": {
-                        "x_center": x_center,
-                        "y_center": y_center,
-                        "width": width,
-                        "height": height
-                    }
-                })
+
+def build_detections(det, image_shape) -> list[dict]:
+    h, w = image_shape[:2]
+
+    detections = []
+    for *xyxy, conf, cls in reversed(det.tolist()):
+        label = COCO_CLASSES.get(int(cls))
+        if label:
+            x1, y1, x2, y2 = xyxy
+            detections.append({
+                "class_": label,
+                "bbox": {
+                    "x_center": (x1 + x2) / 2 / w,
+                    "y_center": (y1 + y2) / 2 / h,
+                    "width": (x2 - x1) / w,
+                    "height": (y2 - y1) / h
+                }
+            })
 
     return detections
 
+
+def persist_debug(content: bytes, detections: list[dict]):
+    # Keep the request image and its detections on disk for offline inspection
+    image_id = str(uuid.uuid4())
+    with open(os.path.join(IMAGE_DIR, f"{image_id}.jpg"), 'wb') as f:
+        f.write(content)
+    with open(os.path.join(RESULTS_DIR, f"{image_id}.json"), 'w') as f:
+        json.dump(detections, f)
+
+
+async def fetch_image(app: FastAPI, url: str) -> bytes:
+    with app.state.metrics.time("fetch"):
+        return await app.state.fetcher.fetch(url)
+
+
+async def decode(app: FastAPI, content: bytes):
+    with app.state.metrics.time("decode"):
+        return await run_in_threadpool(decode_image, content)  # BGR, decoded in memory
+
+
+async def detect_content(
+    app: FastAPI,
+    content: bytes,
+    tile: bool = False,
+    model: str | None = None,
+    budget_ms: float | None = None,
+    deadline: float | None = None,
+    lane: str = "interactive",
+    block: bool = False,
+) -> DetectionResult:
+    cache = app.state.cache
+    entry = app.state.models.resolve(model)  # unknown names fail before any work
+    settings = DetectionSettings(model=entry.name, imgsz=YOLO_IMG_SIZE, tiled=tile, budget_ms=budget_ms)
+    if budget_ms is not None and not tile:
+        # Largest model and size predicted to finish in what is left of the budget
+        remaining = (deadline or time.perf_counter() + budget_ms / 1000) - time.perf_counter()
+        plan = app.state.planner.plan(remaining, model)
+        entry = app.state.models.resolve(plan.model)
+        settings.model, settings.imgsz = plan.model, plan.imgsz or YOLO_IMG_SIZE
+        settings.predicted_ms = None if plan.predicted is None else round(plan.predicted * 1000, 1)
+
+    im0 = None
+    if cache.perceptual:  # perceptual keys need the decoded image
+        im0 = await decode(app, content)
+    key = cache.key(content, im0, variant=f"{entry.name}|{entry.weights}|{settings.imgsz}{'|tiled' if tile else ''}")
+    detections = cache.get(key)
+    if detections is not None:
+        return DetectionResult(message="Detection completed", detections={"objects": detections}, settings=settings)
+
+    # Decode and inference hold an admission slot, interactive requests first
+    async with app.state.admission.slot(lane, block=block):
+        if im0 is None:
+            im0 = await decode(app, content)
+
+        # Batched together with concurrent requests for the same model and size
+        async with app.state.models.use(entry.name) as batcher:
+            imgsz = None if settings.imgsz == batcher.detector.imgsz[0] else settings.imgsz
+            det = await asyncio.wrap_future(batcher.submit(im0, tiled=tile, imgsz=imgsz))
+    with app.state.metrics.time("response_build"):
+        detections = build_detections(det, im0.shape)
+        result = DetectionResult(message="Detection completed", detections={"objects": detections}, settings=settings)
+    cache.put(key, detections)
+    if DEBUG_PERSIST:
+        persist_debug(content, detections)
+
+    return result
+
+
+async def run_detection(
+    app: FastAPI,
+    content: bytes,
+    tile: bool = False,
+    model: str | None = None,
+    budget_ms: float | None = None,
+    deadline: float | None = None,
+    lane: str = "interactive",
+    block: bool = False,
+) -> DetectionResult:
+    # Run detection with timeout; late results stay reachable through the job API
+    task = asyncio.ensure_future(detect_content(app, content, tile, model, budget_ms, deadline, lane, block))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), timeout=DETECTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        job = app.state.jobs.adopt(task)
+        return DetectionResult(
+            message="The image is being processed and has failed to respond within the time limit.",
+            detections=None,
+            job_id=job.id
+        )
+
+
+async def read_upload_file(upload) -> bytes:
+    content = await upload.read(MAX_IMAGE_BYTES + 1)
+    if len(content) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds the {MAX_IMAGE_BYTES} bytes limit")
+    if not content:
+        raise HTTPException(status_code=400, detail="Empty image upload")
+    return content
+
+
+async def read_upload(request: Request) -> bytes:
+    # Accept either a multipart form with a `file` field or the raw image bytes as body
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Multipart upload must contain a 'file' field")
+        return await read_upload_file(upload)
+
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_IMAGE_BYTES:
+            raise HTTPException(status_code=413, detail=f"Image exceeds the {MAX_IMAGE_BYTES} bytes limit")
+        chunks.append(chunk)
+    if not size:
+        raise HTTPException(status_code=400, detail="Empty image upload")
+    return b"".join(chunks)
+
+
+async def run_batch_item(app: FastAPI, index: int, source: str, load, limit: asyncio.Semaphore, tile: bool, model: str | None) -> BatchDetectionResult:
+    # Never raises: failures are reported in the item's message so the stream keeps going
+    async with limit:
+        try:
+            result = await run_detection(app, await load(), tile, model, lane="bulk", block=True)
+        except HTTPException as e:
+            result = DetectionResult(message=str(e.detail))
+        except (FetchError, ValueError) as e:
+            result = DetectionResult(message=str(e))
+        except Exception as e:
+            result = DetectionResult(message=f"Detection failed: {e}")
+    return BatchDetectionResult(
+        index=index,
+        source=source,
+        message=result.message,
+        detections=result.detections,
+        settings=result.settings,
+        job_id=result.job_id,
+    )
+
+
+def client_id(request: Request) -> str:
+    # Callers behind a shared proxy can identify themselves, otherwise the peer address is used
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "unknown")
+
 # Endpoints
 @app.get("/detection", response_model=DetectionResult)
-def detect_from_url(image_url: str = Query(..., description="Public image URL to detect objects")):
+async def detect_from_url(
+    request: Request,
+    image_url: str = Query(..., description="Public image URL to detect objects"),
+    tile: bool = Query(False, description="Sliced inference for small objects in large images"),
+    model: str | None = Query(None, description="Model name from GET /models, the default model if omitted"),
+    budget_ms: float | None = Query(None, gt=0, description="Latency budget; picks the model and image size that fit it"),
+    priority: Literal["interactive", "bulk"] = Query("interactive", description="Admission lane, bulk yields to interactive"),
+):
+    deadline = time.perf_counter() + budget_ms / 1000 if budget_ms else None  # the download counts too
+    admission = request.app.state.admission
+    with admission.client(client_id(request)):
+        admission.check(priority)  # reject before downloading anything
+        try:
+            # Download image
+            content = await fetch_image(request.app, image_url)
+        except ImageTooLargeError as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except FetchError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        try:
+            return await run_detection(request.app, content, tile, model, budget_ms, deadline, priority)
+        except AdmissionError:
+            raise
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/detection", response_model=DetectionResult)
+async def detect_from_upload(
+    request: Request,
+    tile: bool = Query(False, description="Sliced inference for small objects in large images"),
+    model: str | None = Query(None, description="Model name from GET /models, the default model if omitted"),
+    budget_ms: float | None = Query(None, gt=0, description="Latency budget; picks the model and image size that fit it"),
+    priority: Literal["interactive", "bulk"] = Query("interactive", description="Admission lane, bulk yields to interactive"),
+):
+    """
+    Detect objects in an uploaded image, sent either as the raw request body
+    (e.g. `Content-Type: image/jpeg`) or as a multipart form with a `file` field.
+    """
+    deadline = time.perf_counter() + budget_ms / 1000 if budget_ms else None
+    admission = request.app.state.admission
+    with admission.client(client_id(request)):
+        admission.check(priority)  # reject before reading the body
+        content = await read_upload(request)
+
+        try:
+            return await run_detection(request.app, content, tile, model, budget_ms, deadline, priority)
+        except AdmissionError:
+            raise
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/detection/batch")
+async def detect_batch(
+    request: Request,
+    tile: bool = Query(False, description="Sliced inference for small objects in large images"),
+    model: str | None = Query(None, description="Model name from GET /models, the default model if omitted"),
+):
+    """
+    Detect objects in many images with one call. The body is either JSON
+    `{"image_urls": [...]}` or a multipart form with one or more `files` fields.
+
+    Images are fetched and detected concurrently and the response streams one
+    NDJSON line (`BatchDetectionResult`) per image as soon as it is done, so
+    lines arrive in completion order; use `index` to match them to the request.
+    Images go through the bulk admission lane and wait for a slot rather than fail.
+    """
+    try:
+        request.app.state.models.resolve(model)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    admission, client = request.app.state.admission, client_id(request)
+    admission.check_client(client)
+    admission.check("bulk")
+
+    items = []
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        for upload in form.getlist("files"):
+            if isinstance(upload, str):
+                continue
+            items.append((upload.filename or "", functools.partial(read_upload_file, upload)))
+    else:
+        try:
+            body = BatchDetectionRequest(**await request.json())
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Invalid batch request: {e}")
+        items = [(url, functools.partial(fetch_image, request.app, url)) for url in body.image_urls]
+
+    if not items:
+        raise HTTPException(status_code=400, detail="Batch request contains no images")
+    if len(items) > BATCH_REQUEST_MAX_IMAGES:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_REQUEST_MAX_IMAGES} images")
+
+    async def stream():
+        limit = asyncio.Semaphore(BATCH_REQUEST_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(run_batch_item(request.app, i, source, load, limit, tile, model))
+            for i, (source, load) in enumerate(items)
+        ]
+        try:
+            with admission.client(client, enforce=False):  # counted while the stream runs
+                for task in asyncio.as_completed(tasks):
+                    yield json.dumps(jsonable_encoder(await task)) + "\n"
+        finally:
+            for task in tasks:  # client went away, stop outstanding work
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.post("/detection/jobs", response_model=JobStatus, status_code=202)
+async def submit_detection_job(
+    request: Request,
+    image_url: str | None = Query(None, description="Public image URL to detect objects"),
+    tile: bool = Query(False, description="Sliced inference for small objects in large images"),
+    model: str | None = Query(None, description="Model name from GET /models, the default model if omitted"),
+):
+    """
+    Queue a detection and return its job id immediately. Pass `image_url`, or
+    upload the image as with `POST /detection`. Poll `GET /detection/jobs/{job_id}`
+    for the result.
+    """
+    if image_url is not None:
+        load = functools.partial(fetch_image, request.app, image_url)
+    else:
+        content = await read_upload(request)
+
+        async def load():
+            return content
+
     try:
-        # Download image
-        response = requests.get(image_url, timeout=10)
-        if response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Failed to download image from URL")
-
-        image_id = str(uuid.uuid4())
-        image_path = os.path.join(IMAGE_DIR, f"{image_id}.jpg")
-        result_name = image_id  # used for YOLO's output folders
-
-        with open(image_path, 'wb') as f:
-            f.write(response.content)
-
-        # Run detection with timeout
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(run_detection, image_path, result_name)
-            try:
-                detections = future.result(timeout=DETECTION_TIMEOUT)
-            except concurrent.futures.TimeoutError:
-                return DetectionResult(
-                    message="The image is being processed and has failed to respond within the time limit.",
-                    detections=None
-                )
-
-        return DetectionResult(message="Detection completed", detections={"objects": detections})
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        request.app.state.models.resolve(model)
+        job = request.app.state.jobs.submit(load, tile=tile, model=model, lane="bulk", block=True)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    return JobStatus(job_id=job.id, status=job.status)
+
+
+@app.get("/detection/jobs/{job_id}", response_model=JobStatus)
+def get_detection_job(request: Request, job_id: str):
+    job = request.app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job id")
+    return JobStatus(job_id=job.id, status=job.status, result=job.result, error=job.error)
+
+
+@app.get("/models")
+def list_models(request: Request):
+    """Registry models with their weights, load state and memory use."""
+    return request.app.state.models.stats()
+
+
+@app.get("/admission/stats")
+def admission_stats(request: Request):
+    """Admission slots, queue depth per lane and rejection counters, e.g. as an autoscaling signal."""
+    return request.app.state.admission.stats()
+
+
+@app.get("/cache/stats")
+def cache_stats(request: Request):
+    return request.app.state.cache.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics(request: Request):
+    """Prometheus text exposition of stage latencies, batch sizes, queue depths and cache counters."""
+    return PlainTextResponse(request.app.state.metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import contextlib
+import math
+import time
+
+LANES = ("interactive", "bulk")  # highest priority first
+
+
+class AdmissionError(Exception):
+    """A request was turned away; `retry_after` is a hint in seconds."""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Overloaded(AdmissionError):
+    """The admission queue of the lane is full, or the wait for a slot timed out."""
+
+
+class ClientLimitExceeded(AdmissionError):
+    """The client already has its maximum number of requests in progress."""
+
+
+class AdmissionController:
+    """
+    Bounded admission for detections, with priority lanes and per-client limits.
+
+    At most `max_active` detections hold a slot at a time; the others wait in
+    the queue of their lane, bounded to `max_queued[lane]`. A freed slot goes
+    to the oldest interactive waiter before any bulk one. Requests arriving
+    to a full lane, or waiting longer than `queue_timeout`, are rejected right
+    away with `Overloaded` instead of piling up until everything times out;
+    blocking callers (batch items, background jobs) wait as long as needed.
+    Each client may have `client_limit` requests in progress. All state lives
+    on the event loop, so no locking is needed. `max_active` 0 disables slots.
+    """
+
+    def __init__(
+        self,
+        max_active: int = 32,
+        max_queued: dict[str, int] | None = None,
+        queue_timeout: float = 10.0,
+        client_limit: int = 0,
+    ):
+        self.max_active = max_active
+        self.max_queued = {"interactive": 64, "bulk": 256, **(max_queued or {})}
+        self.queue_timeout = queue_timeout
+        self.client_limit = client_limit
+        self.active = 0
+        self.admitted = {lane: 0 for lane in LANES}
+        self.rejected = {"queue_full": 0, "queue_timeout": 0, "client_limit": 0}
+        self._waiters = {lane: collections.deque() for lane in LANES}
+        self._clients = collections.Counter()
+        self._hold = 0.1  # EWMA of seconds a slot is held, for Retry-After
+
+    def queued(self, lane: str) -> int:
+        return sum(not waiter.done() for waiter in self._waiters[lane])
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog should have drained."""
+        backlog = sum(self.queued(lane) for lane in LANES) + 1
+        return min(60, max(1, math.ceil(self._hold * backlog / max(1, self.max_active))))
+
+    def check(self, lane: str):
+        """Reject early when the lane queue is already full, before any work is done for the request."""
+        if self.max_active and self.active >= self.max_active and self.queued(lane) >= self.max_queued[lane]:
+            self.rejected["queue_full"] += 1
+            raise Overloaded(f"Service overloaded, {lane} queue is full", self.retry_after())
+
+    def check_client(self, client_id: str):
+        if self.client_limit and self._clients[client_id] >= self.client_limit:
+            self.rejected["client_limit"] += 1
+            raise ClientLimitExceeded(
+                f"Too many concurrent requests, at most {self.client_limit} per client", self.retry_after()
+            )
+
+    @contextlib.contextmanager
+    def client(self, client_id: str, enforce: bool = True):
+        """
+        Count a request against its client's concurrency limit for as long as it runs.
+        With `enforce` off the request is only counted (it was checked with `check_client` earlier).
+        """
+        if enforce:
+            self.check_client(client_id)
+        self._clients[client_id] += 1
+        try:
+            yield
+        finally:
+            self._clients[client_id] -= 1
+            if not self._clients[client_id]:
+                del self._clients[client_id]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane: str = "interactive", block: bool = False):
+        """Hold a detection slot; `block` waits without queue bound or timeout instead of raising Overloaded."""
+        if not self.max_active:
+            yield
+            return
+        if self.active < self.max_active and not any(self.queued(name) for name in LANES):
+            self.active += 1
+        else:
+            await self._wait(lane, block)
+        self.admitted[lane] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._hold += 0.1 * (time.perf_counter() - start - self._hold)
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": {lane: self.queued(lane) for lane in LANES},
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "clients": len(self._clients),
+            "retry_after": self.retry_after(),
+        }
+
+    async def _wait(self, lane, block):
+        if not block and self.queued(lane) >= self.max_queued[lane]:
+            self.rejected["queue_full"] += 1
+            raise Overloaded(f"Service overloaded, {lane} queue is full", self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), None if block else self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self.rejected["queue_timeout"] += 1
+                raise Overloaded(f"Service overloaded, no slot within {self.queue_timeout:g}s", self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # slot was handed over just before the cancellation
+                self._release()
+            waiter.cancel()
+            raise
+
+    def _release(self):
+        # Hand the slot to the oldest waiter of the highest priority lane, else free it
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.active -= 1
@@ -0,0 +1,141 @@
+import functools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from detector.budget import CostProfile
+from detector.metrics import Metrics
+from detector.model import YoloDetector
+from detector.workers import InferencePool
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent detection requests into batched forward passes.
+
+    Images submitted from request threads are queued; a dispatch thread
+    collects up to `max_batch_size` of them, waiting at most `max_wait_ms`
+    after the first one arrives, runs them through the detector as one batch
+    and resolves each request's future with its own detections. With an
+    `InferencePool` as detector, `num_threads` dispatch threads keep that many
+    batches in flight, one per worker process. Queue wait, batch sizes and the
+    detector's stage timings are recorded in `metrics`, and the cost of every
+    batch by image size in `costs`.
+    """
+
+    def __init__(
+        self,
+        detector: YoloDetector | InferencePool,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        num_threads: int = 1,
+        metrics: Metrics | None = None,
+    ):
+        self.detector = detector
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.num_threads = max(1, num_threads)
+        self.metrics = metrics or Metrics()
+        self.costs = CostProfile(detector.cost_profile)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._running = 0  # images in batches being run
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._loop, name=f"micro-batcher-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)  # one sentinel per thread
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, im0, tiled: bool = False, imgsz: int | None = None) -> Future:
+        """
+        Queue a BGR image; the returned future resolves to its (n, 6) detections tensor.
+        Images are batched with others of the same inference size `imgsz` (None for the
+        detector's default). Tiled images are already a batch of tiles and run on their own.
+        """
+        future = Future()
+        self._queue.put((im0, future, tiled, imgsz, time.perf_counter()))
+        return future
+
+    def qsize(self) -> int:
+        """Images waiting for a forward pass."""
+        return self._queue.qsize()
+
+    def pending(self) -> int:
+        """Images waiting for or in a forward pass."""
+        return self._queue.qsize() + self._running
+
+    def _collect(self, first) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:  # stop requested, finish this batch first
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            # Drop requests whose caller already gave up (timed out / cancelled)
+            items = [item for item in self._collect(first) if item[1].set_running_or_notify_cancel()]
+            now = time.perf_counter()
+            groups = {}  # imgsz -> [(im0, future)], images of one forward pass share a size
+            for im0, future, tiled, imgsz, submitted in items:
+                self.metrics.observe("queue_wait", now - submitted)
+                if not tiled:
+                    groups.setdefault(imgsz, []).append((im0, future))
+            self._track(len(items))
+            try:
+                for imgsz, batch in groups.items():
+                    self.metrics.batch_size.observe(len(batch))
+                    fn = functools.partial(self._detect_batch, imgsz=imgsz)
+                    self._run(fn, [im0 for im0, _ in batch], [future for _, future in batch])
+                for im0, future, tiled, *_ in items:
+                    if tiled:
+                        self._run(self._detect_tiled, [im0], [future])
+            finally:
+                self._track(-len(items))
+
+    def _track(self, n):
+        with self._lock:
+            self._running += n
+
+    def _detect_batch(self, ims, timings, imgsz=None):
+        dets = self.detector.detect_batch(ims, timings, imgsz=imgsz)
+        seconds = sum(timings.get(stage, 0.0) for stage in ("preprocess", "inference", "nms"))
+        self.costs.observe(imgsz or self.detector.imgsz[0], len(ims), seconds)
+        return dets
+
+    def _detect_tiled(self, ims, timings):
+        return [self.detector.detect_tiled(im0, timings) for im0 in ims]
+
+    def _run(self, fn, ims, futures):
+        timings = {}
+        try:
+            results = fn(ims, timings)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for stage, seconds in timings.items():
+            self.metrics.observe(stage, seconds)
+        for future, det in zip(futures, results):
+            future.set_result(det)
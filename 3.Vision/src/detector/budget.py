@@ -0,0 +1,128 @@
+import math
+import os
+import threading
+
+
+class CostProfile:
+    """
+    Measured seconds per forward pass of one model, by (imgsz, batch size).
+
+    Seeded with single-image timings taken when the model loads and refined
+    with every batch the model actually runs (exponential moving average).
+    Batch sizes not seen yet are extrapolated linearly from the nearest
+    measured one, which overestimates since batching is sub-linear.
+    """
+
+    def __init__(self, seed: dict[int, float] | None = None, alpha: float = 0.2):
+        self.alpha = alpha
+        self._costs = {(imgsz, 1): seconds for imgsz, seconds in (seed or {}).items()}  # (imgsz, batch) -> seconds
+        self._lock = threading.Lock()
+
+    @property
+    def sizes(self) -> list[int]:
+        """Profiled image sizes, largest first."""
+        with self._lock:
+            return sorted({imgsz for imgsz, _ in self._costs}, reverse=True)
+
+    def observe(self, imgsz: int, batch: int, seconds: float):
+        with self._lock:
+            previous = self._costs.get((imgsz, batch))
+            self._costs[(imgsz, batch)] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def estimate(self, imgsz: int, batch: int) -> float | None:
+        with self._lock:
+            measured = [(b, seconds) for (size, b), seconds in self._costs.items() if size == imgsz]
+        if not measured:
+            return None
+        b, seconds = min(measured, key=lambda item: (abs(item[0] - batch), -item[0]))
+        return seconds if b == batch else seconds / b * batch
+
+
+class Plan:
+    def __init__(self, model: str, imgsz: int | None = None, predicted: float | None = None):
+        self.model = model
+        self.imgsz = imgsz  # None keeps the model's default size
+        self.predicted = predicted  # seconds
+
+
+class BudgetPlanner:
+    """
+    Chooses the model and image size for a request with a latency budget.
+
+    Candidates are the registered models (or only the requested one) at each
+    of their profiled sizes, ordered from most to least expensive, i.e. from
+    the biggest model at the largest size down. The predicted latency of a
+    loaded candidate is the time to drain the images already waiting for that
+    model plus its own batch, so the choice degrades to cheaper settings as
+    queues build up. A model that is not loaded adds its load time to a single
+    image pass, both as measured when it was last loaded, or else scaled from
+    the most recently used loaded model by weights file size; with neither it
+    is not a candidate. The first candidate predicted to fit the remaining
+    budget wins; when none fits the cheapest one is used rather than letting
+    the request time out.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._profiles = {}  # name -> CostProfile, kept once the model is unloaded
+
+    def plan(self, remaining: float, model: str | None = None) -> Plan:
+        names = [self.registry.resolve(model).name] if model is not None else self.registry.names
+        loaded = self.registry.loaded()
+        self._profiles.update({name: batcher.costs for name, batcher in loaded.items()})
+        reference = next(reversed(loaded), None)  # most recently used loaded model
+
+        candidates = []  # (cost rank, imgsz, name, predicted)
+        for name in names:
+            batcher = loaded.get(name)
+            if batcher is not None:
+                costs = batcher.costs
+                predicted = {imgsz: self.predict(batcher, imgsz) for imgsz in costs.sizes}
+            else:
+                cold = self.cold_costs(name, reference)
+                if cold is None:  # never loaded and nothing to scale from
+                    continue
+                costs, start = cold
+                predicted = {imgsz: start + costs.estimate(imgsz, 1) for imgsz in costs.sizes}
+            sizes = costs.sizes
+            rank = costs.estimate(sizes[0], 1) if sizes else 0.0
+            for imgsz in sizes:
+                candidates.append((rank, imgsz, name, predicted[imgsz]))
+        if not candidates:
+            return Plan(model=self.registry.resolve(model).name, imgsz=None, predicted=None)
+
+        candidates.sort(key=lambda c: (c[0], c[1]), reverse=True)  # most capable first
+        fits = [c for c in candidates if c[3] <= remaining]
+        _, imgsz, name, predicted = fits[0] if fits else min(candidates, key=lambda c: c[3])
+        return Plan(model=name, imgsz=imgsz, predicted=predicted)
+
+    def cold_costs(self, name: str, reference: str | None):
+        # (CostProfile, seconds before its first batch runs) of a model that is not loaded
+        entry, loaded = self.registry.resolve(name), self.registry.loaded()
+        costs, load = self._profiles.get(name), entry.load_seconds
+        if costs is None or load is None:
+            if reference is None:
+                return None
+            ref_entry, ref_costs = self.registry.resolve(reference), loaded[reference].costs
+            scale = _file_size(entry.weights) / max(_file_size(ref_entry.weights), 1)
+            if costs is None:
+                costs = CostProfile({imgsz: ref_costs.estimate(imgsz, 1) * scale for imgsz in ref_costs.sizes})
+            if load is None:
+                load = (ref_entry.load_seconds or 0.0) * scale
+        max_wait = loaded[reference].max_wait if reference is not None else 0.0
+        return costs, load + max_wait
+
+    @staticmethod
+    def predict(batcher, imgsz: int) -> float:
+        # Images ahead of this one are drained max_batch_size at a time, num_threads batches in parallel
+        pending = batcher.pending() + 1
+        batch = min(pending, batcher.max_batch_size)
+        rounds = math.ceil(pending / (batcher.max_batch_size * batcher.num_threads))
+        return batcher.max_wait + rounds * batcher.costs.estimate(imgsz, batch)
+
+
+def _file_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -0,0 +1,171 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def dhash(im0, size: int = 8) -> str:
+    """Perceptual difference hash of a BGR image, stable under re-encoding and resizing."""
+    gray = cv2.cvtColor(im0, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of detection results.
+
+    Entries are keyed by the image content (SHA-256 of the bytes, or a perceptual
+    hash of the decoded image when `perceptual` is set) together with a namespace
+    describing the model settings, so changing the model, image size, confidence
+    or classes never returns stale results. The in-memory tier is an LRU bounded
+    to `max_entries` with a TTL; an optional on-disk tier under `disk_dir` keeps
+    results across restarts and memory evictions.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        max_entries: int = 1024,
+        ttl: float = 300.0,
+        disk_dir: str | None = None,
+        disk_max_entries: int = 100_000,
+        perceptual: bool = False,
+    ):
+        self.namespace = hashlib.sha256(namespace.encode()).hexdigest()[:16]
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self.perceptual = perceptual
+        self.hits = self.disk_hits = self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, list]] = OrderedDict()  # key -> (expiry, value)
+        self._lock = threading.Lock()
+        self._puts = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or bool(self.disk_dir)
+
+    def key(self, content: bytes, im0=None, variant: str = "") -> str:
+        """
+        Cache key for an image; `im0` (decoded BGR array) is required in perceptual mode.
+        `variant` separates results of the same image computed differently (e.g. another model, tiled).
+        """
+        digest = dhash(im0) if self.perceptual else hashlib.sha256(content).hexdigest()
+        prefix = hashlib.sha256(f"{self.namespace}|{variant}".encode()).hexdigest()[:16] if variant else self.namespace
+        return f"{prefix}-{digest}"
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]  # expired
+
+        entry = self._disk_get(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, *entry)  # promote to memory
+        return entry[1]
+
+    def put(self, key: str, value: list):
+        if not self.enabled:
+            return
+        expiry = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expiry, value)
+            self._puts += 1
+            prune = self.disk_dir and self._puts % 256 == 0
+        if self.disk_dir:
+            self._disk_put(key, expiry, value)
+            if prune:
+                self._disk_prune()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def _remember(self, key, expiry, value):
+        # Caller holds the lock
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (expiry, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)  # least recently used
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expiry"] <= now:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            return None
+        return entry["expiry"], entry["value"]
+
+    def _disk_put(self, key, expiry, value):
+        path = self._disk_path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"expiry": expiry, "value": value}, f)
+            os.replace(tmp, path)  # atomic, readers never see partial files
+        except OSError:
+            pass  # the disk tier is best effort
+
+    def _disk_prune(self):
+        # Drop expired files, then the oldest ones beyond disk_max_entries
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if mtime + self.ttl <= now:
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+            else:
+                files.append((mtime, entry.path))
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.disk_max_entries)]:
+            with contextlib.suppress(OSError):
+                os.remove(path)
@@ -0,0 +1,86 @@
+import asyncio
+
+import httpx
+
+
+class FetchError(Exception):
+    """The image could not be downloaded from the given URL."""
+
+
+class ImageTooLargeError(FetchError):
+    """The image is larger than the configured size cap."""
+
+
+class _HostLimit:
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0  # downloads holding or waiting for the semaphore
+
+
+class ImageFetcher:
+    """
+    Shared, connection-pooled async HTTP client for downloading request images.
+
+    Connections are reused across requests, concurrent downloads from the same
+    host are capped with a per-host semaphore and bodies are streamed so that
+    oversized images are rejected before they are fully read. A host's
+    semaphore only exists while downloads from it are running or waiting, so
+    arbitrary URLs do not grow the table.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_per_host: int = 10,
+        max_bytes: int = 20 * 1024 * 1024,
+        timeout: float = 10.0,
+    ):
+        self.max_per_host = max_per_host
+        self.max_bytes = max_bytes
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout,
+            follow_redirects=True,
+        )
+        self._host_limits: dict[str, _HostLimit] = {}
+
+    async def fetch(self, url: str) -> bytes:
+        """Download `url` and return its body, raising FetchError on failure."""
+        try:
+            host = httpx.URL(url).host
+        except httpx.InvalidURL as e:
+            raise FetchError(f"Invalid image URL: {e}") from e
+        limit = self._host_limits.get(host)
+        if limit is None:
+            limit = self._host_limits[host] = _HostLimit(self.max_per_host)
+        limit.users += 1
+        try:
+            async with limit.semaphore:
+                return await self._download(url)
+        finally:
+            limit.users -= 1
+            if not limit.users:
+                del self._host_limits[host]
+
+    async def _download(self, url: str) -> bytes:
+        try:
+            async with self._client.stream("GET", url) as response:
+                if response.status_code != 200:
+                    raise FetchError(f"Failed to download image from URL (HTTP {response.status_code})")
+                length = response.headers.get("content-length")
+                if length and length.isdigit() and int(length) > self.max_bytes:
+                    raise ImageTooLargeError(f"Image exceeds the {self.max_bytes} bytes limit")
+
+                chunks, size = [], 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ImageTooLargeError(f"Image exceeds the {self.max_bytes} bytes limit")
+                    chunks.append(chunk)
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            raise FetchError(f"Failed to download image from URL: {e}") from e
+
+        return b"".join(chunks)
+
+    async def aclose(self):
+        await self._client.aclose()
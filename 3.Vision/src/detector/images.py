@@ -0,0 +1,10 @@
+import cv2
+import numpy as np
+
+
+def decode_image(data: bytes):
+    """Decode encoded image bytes (JPEG, PNG, ...) in memory into a BGR HWC array."""
+    im0 = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if im0 is None:
+        raise ValueError("Could not decode image data")
+    return im0
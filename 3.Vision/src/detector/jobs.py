@@ -0,0 +1,124 @@
+import asyncio
+import time
+import uuid
+
+
+class JobQueueFull(Exception):
+    """The job queue is at capacity; the caller should retry later."""
+
+
+class Job:
+    def __init__(self, expires_at: float):
+        self.id = str(uuid.uuid4())
+        self.status = "queued"  # queued -> running -> completed | failed | expired
+        self.result = None
+        self.error = None
+        self.expires_at = expires_at  # queued jobs not started by then are dropped
+        self.finished_at = None
+        self.task = None  # asyncio task while running
+
+    def finish(self, status: str, result=None, error: str | None = None):
+        self.status, self.result, self.error = status, result, error
+        self.finished_at = time.monotonic()
+        self.task = None
+
+
+class JobManager:
+    """
+    Asynchronous detection jobs backed by a bounded in-memory queue.
+
+    `submit` enqueues work and returns immediately with a `Job` whose id can be
+    polled; `concurrency` consumer tasks run queued jobs through `run`. A job
+    still queued after `expiry` seconds is dropped without running, and
+    finished jobs are kept for `retention` seconds before they are forgotten.
+    `adopt` tracks work that is already running (e.g. a request that hit its
+    timeout) so its result stays reachable instead of being thrown away.
+    """
+
+    def __init__(self, run, max_queued: int = 100, concurrency: int = 8, expiry: float = 60.0, retention: float = 600.0):
+        self.run = run  # async callable: image bytes -> result
+        self.max_queued = max_queued
+        self.concurrency = concurrency
+        self.expiry = expiry
+        self.retention = retention
+        self._jobs: dict[str, Job] = {}
+        self._queue = None
+        self._tasks = []
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for job in self._jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, load, **options) -> Job:
+        """Queue a job; `load` is an async callable returning the image bytes, `options` go to `run`."""
+        job = Job(expires_at=time.monotonic() + self.expiry)
+        try:
+            self._queue.put_nowait((job, load, options))
+        except asyncio.QueueFull:
+            raise JobQueueFull(f"Job queue is full ({self.max_queued} jobs)")
+        self._jobs[job.id] = job
+        return job
+
+    def adopt(self, task: asyncio.Future) -> Job:
+        """Track an already running detection so its result can be polled later."""
+        job = Job(expires_at=time.monotonic() + self.expiry)
+        job.status, job.task = "running", task
+        self._jobs[job.id] = job
+        task.add_done_callback(lambda t: self._settle(job, t))
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        counts = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"queued": self._queue.qsize() if self._queue else 0, "max_queued": self.max_queued, "jobs": counts}
+
+    async def _consume(self):
+        while True:
+            job, load, options = await self._queue.get()
+            if job.finished_at is not None:  # already expired by the sweeper
+                continue
+            if time.monotonic() > job.expires_at:  # waited too long, never started
+                job.finish("expired", error="Job expired before it started")
+                continue
+            job.status = "running"
+            job.task = asyncio.ensure_future(self._execute(load, options))
+            job.task.add_done_callback(lambda task, job=job: self._settle(job, task))
+            await asyncio.wait({job.task})
+
+    async def _execute(self, load, options):
+        return await self.run(await load(), **options)
+
+    def _settle(self, job, task):
+        if job.finished_at is not None:
+            return
+        if task.cancelled():
+            job.finish("failed", error="Job was cancelled")
+        elif task.exception() is not None:
+            job.finish("failed", error=str(task.exception()))
+        else:
+            job.finish("completed", result=task.result())
+
+    async def _sweep(self):
+        # Expire jobs still waiting in the queue and forget finished ones after the retention period
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for job_id, job in list(self._jobs.items()):
+                if job.status == "queued" and now > job.expires_at:
+                    job.finish("expired", error="Job expired before it started")
+                elif job.finished_at is not None and now - job.finished_at > self.retention:
+                    del self._jobs[job_id]
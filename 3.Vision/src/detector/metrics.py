@@ -0,0 +1,97 @@
+import bisect
+import contextlib
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def _labels(**labels) -> str:
+    pairs = ",".join(f'{k}="{v}"' for k, v in labels.items() if v is not None)
+    return f"{{{pairs}}}" if pairs else ""
+
+
+class Histogram:
+    """Prometheus histogram, optionally split by the value of one label."""
+
+    def __init__(self, name: str, documentation: str, buckets, labelname: str | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelname = labelname
+        self._series = {}  # label value -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, label: str | None = None):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label: list(values) for label, values in self._series.items()}
+        for label, values in sorted(series.items(), key=lambda item: item[0] or ""):
+            key = {self.labelname: label} if self.labelname else {}
+            cumulative = 0
+            for bound, n in zip(self.buckets, values):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(**key, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(**key, le='+Inf')} {values[-1]}")
+            lines.append(f"{self.name}_sum{_labels(**key)} {values[-2]}")
+            lines.append(f"{self.name}_count{_labels(**key)} {values[-1]}")
+        return lines
+
+
+class Metrics:
+    """
+    Service metrics rendered in the Prometheus text format.
+
+    Request stages (fetch, decode, queue wait, preprocess, inference, NMS,
+    response build) go into one latency histogram labelled by `stage`, and
+    the size of every forward pass into a batch size histogram. Recording is
+    a bisect plus a lock per observation. Values that already live elsewhere
+    (queue depths, cache counters) are registered as callbacks with `collect`
+    and only read when `/metrics` is scraped.
+    """
+
+    def __init__(self):
+        self.stages = Histogram("detection_stage_seconds", "Time spent in each detection stage.", LATENCY_BUCKETS, "stage")
+        self.batch_size = Histogram("detection_batch_size", "Images per forward pass.", BATCH_SIZE_BUCKETS)
+        self._collectors = []  # (name, type, documentation, labelname, callback)
+
+    def observe(self, stage: str, seconds: float):
+        self.stages.observe(seconds, stage)
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def collect(self, name: str, kind: str, documentation: str, callback, labelname: str | None = None):
+        """
+        Register a gauge or counter read at scrape time. `callback` returns a number,
+        or a {label value: number} dict when `labelname` is given.
+        """
+        self._collectors.append((name, kind, documentation, labelname, callback))
+
+    def render(self) -> str:
+        lines = self.stages.render() + self.batch_size.render()
+        for name, kind, documentation, labelname, callback in self._collectors:
+            lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+            values = callback()
+            if labelname:
+                lines += [f"{name}{_labels(**{labelname: label})} {value}" for label, value in values.items()]
+            else:
+                lines.append(f"{name} {values}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,245 @@
+import hashlib
+import itertools
+import os
+import sys
+import threading
+
+import numpy as np
+
+# Make the vendored YOLOv9 packages (models/, utils/) importable
+YOLO_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils", "yolov9")
+if YOLO_ROOT not in sys.path:
+    sys.path.append(YOLO_ROOT)
+
+from export import run as export_model  # noqa: E402
+from models.common import DetectMultiBackend  # noqa: E402
+from models.experimental import save_serving_checkpoint  # noqa: E402
+from utils.augmentations import LetterboxBuffer, to_tensor  # noqa: E402
+from utils.general import Profile, check_img_size, non_max_suppression, scale_boxes  # noqa: E402
+from utils.nms import NMS_METHODS  # noqa: E402
+from utils.optimize import OPTIMIZE_MODES  # noqa: E402
+from utils.tiling import tiled_inference  # noqa: E402
+from utils.torch_utils import select_device, smart_inference_mode  # noqa: E402
+
+
+def _derived_path(weights: str, directory: str, suffix: str, *keys) -> str:
+    # File in `directory` named by the source file (path, size, modification time) and `keys`
+    stat = os.stat(weights)
+    source = "|".join(map(str, (os.path.abspath(weights), stat.st_size, stat.st_mtime_ns, *keys)))
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    return os.path.join(directory, f"{stem}-{hashlib.sha1(source.encode()).hexdigest()[:12]}{suffix}")
+
+
+def serving_checkpoint(weights: str, directory: str, half: bool = False) -> str:
+    """
+    Path of the serving checkpoint of `weights` in `directory`, built on first use.
+
+    The name is keyed by the source file (path, size, modification time) and
+    dtype, so replaced weights get a new checkpoint. Only PyTorch `.pt` weights
+    are converted; other formats and existing serving checkpoints are returned as is.
+    """
+    if not weights.endswith(".pt") or weights.endswith(".serving.pt"):
+        return weights
+    path = _derived_path(weights, directory, ".serving.pt", half)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        save_serving_checkpoint(weights, path, half=half)
+    return path
+
+
+def onnx_model(weights: str, directory: str) -> str:
+    """
+    Path of the ONNX export of `weights` in `directory`, exported on first use.
+
+    The model is exported by export.py with dynamic batch and image size, so it
+    serves every batch and budget size. Named like `serving_checkpoint`; only
+    PyTorch `.pt` weights are exported, other formats are returned as is.
+    """
+    if not weights.endswith(".pt"):
+        return weights
+    path = _derived_path(weights, directory, ".onnx")
+    if not os.path.exists(path):
+        # export.py writes next to its input: export a link named after the target, then rename
+        os.makedirs(directory, exist_ok=True)
+        link = f"{os.path.splitext(path)[0]}.{os.getpid()}.pt"
+        os.symlink(os.path.abspath(weights), link)
+        try:
+            exported = export_model(weights=link, include=("onnx",), dynamic=True)
+        finally:
+            os.remove(link)
+        if not exported:
+            raise RuntimeError(f"ONNX export of {weights} failed")
+        os.replace(exported[0], path)
+    return path
+
+
+class YoloDetector:
+    """
+    YOLO model kept resident in memory for the lifetime of the service.
+
+    The weights are loaded, fused and warmed up once; every call to `detect`
+    then runs letterbox -> forward -> NMS directly on the loaded model. Warmup
+    runs a forward pass for every batch size in `warmup_batch_sizes` at the
+    default and each of `profile_sizes`, on CPU as well, so the first requests
+    of each shape do not pay for lazy initialization. The single-image cost of
+    each of `profile_sizes` is then measured into `cost_profile`
+    ({stride-aligned imgsz: seconds}) for latency budgeting.
+
+    With `optimize` (see utils/optimize.py) the model runs channels_last, TorchScript
+    frozen or torch.compiled, built per input shape during warmup or on the first
+    request of a new shape, and kept in `optimize_cache` for later starts when set.
+    ONNX weights run on ONNX Runtime with `ort_threads` (intra-op, inter-op, 0 for
+    its defaults) and their optimized graph kept in `optimize_cache` (see utils/ort.py).
+    """
+
+    def __init__(
+        self,
+        weights: str,
+        imgsz: int = 640,
+        device: str = "",
+        conf_thres: float = 0.25,
+        iou_thres: float = 0.45,
+        classes: list[int] | None = None,
+        max_det: int = 1000,
+        nms: str = "nms",
+        half: bool = False,
+        optimize: str | None = None,
+        optimize_cache: str | None = None,
+        ort_threads: tuple[int, int] = (0, 0),
+        tile_overlap: float = 0.2,
+        tile_batch_size: int = 8,
+        tile_merge: str = "nms",
+        tile_full_imgsz: int = 0,
+        profile_sizes: tuple[int, ...] = (),
+        warmup_batch_sizes: tuple[int, ...] = (1,),
+    ):
+        if nms not in NMS_METHODS:
+            raise ValueError(f"Unknown NMS method '{nms}', valid values are {', '.join(NMS_METHODS)}")
+        if optimize and optimize not in OPTIMIZE_MODES:
+            raise ValueError(f"Unknown optimize mode '{optimize}', valid values are {', '.join(OPTIMIZE_MODES)}")
+        self.device = select_device(device)
+        self.model = DetectMultiBackend(
+            weights,
+            device=self.device,
+            fp16=half,
+            optimize=optimize,
+            cache_dir=optimize_cache,
+            ort_threads=tuple(ort_threads),
+        )
+        self.stride, self.names, self.pt = self.model.stride, self.model.names, self.model.pt
+        self.imgsz = check_img_size((imgsz, imgsz), s=self.stride)
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.classes = classes
+        self.max_det = max_det
+        self.nms = nms  # suppression method, see utils/nms.py
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+        self.tile_merge = tile_merge
+        self.tile_full_imgsz = check_img_size(tile_full_imgsz, s=self.stride) if tile_full_imgsz else 0
+        self._lock = threading.Lock()  # one forward pass at a time on the shared model
+        self._buffers = threading.local()  # letterbox buffer of each preprocessing thread
+        self.warmup(profile_sizes, warmup_batch_sizes)
+        # Resident size of the weights; exported backends hold no torch parameters, use the file size
+        tensors = itertools.chain(self.model.parameters(), self.model.buffers())
+        self.nbytes = sum(t.numel() * t.element_size() for t in tensors) or os.path.getsize(weights)
+        self.cost_profile = self.measure_costs(profile_sizes)
+
+    def warmup(self, sizes=(), batch_sizes=(1,)):
+        """One forward pass per (batch size, stride-aligned size), the default size included."""
+        sizes = dict.fromkeys([self.imgsz[0], *(check_img_size(size, s=self.stride) for size in sizes)])
+        for size in sizes:
+            for batch_size in dict.fromkeys(batch_sizes):
+                self.model.warmup(imgsz=(batch_size, 3, size, size), cpu=True)
+
+    def measure_costs(self, sizes) -> dict[int, float]:
+        """Seconds for one image (preprocess + forward + NMS) at each stride-aligned size, best of two runs."""
+        costs = {}
+        for size in sizes:
+            size = check_img_size(size, s=self.stride)
+            im = np.zeros((size, size, 3), dtype=np.uint8)
+            runs = []
+            for _ in range(2):
+                timings = {}
+                self.detect_batch([im], timings, imgsz=size)
+                runs.append(sum(timings.values()))
+            costs[size] = min(runs)
+        return costs
+
+    def preprocess(self, ims, imgsz: int | None = None):
+        """
+        Letterbox BGR HWC images into one normalized Bx3xHxW batch tensor.
+
+        A single image keeps the minimum stride-aligned rectangle; several images
+        are padded to the full inference size (`imgsz` or the default) so they can share one batch.
+        Images are resized straight into the rows of a reusable per-thread buffer, which
+        is converted to the model input in one pass (BGR to RGB, HWC to CHW and scaling fused).
+        """
+        new_shape = check_img_size((imgsz, imgsz), s=self.stride) if imgsz else self.imgsz
+        auto = self.pt and len(ims) == 1
+        buffer = getattr(self._buffers, "value", None)
+        if buffer is None:
+            buffer = self._buffers.value = LetterboxBuffer(len(ims), new_shape)
+        buffer.reserve(len(ims), new_shape)
+        shapes = []
+        for i, im0 in enumerate(ims):
+            im, ratio, pad = buffer.letterbox(i, im0, new_shape, stride=self.stride, auto=auto)
+            shapes.append((im0.shape, (ratio, pad)))
+        batch = to_tensor(buffer.rows(0, len(ims), im.shape[:2]), self.device, self.model.fp16, bgr_hwc=True)
+        return batch, shapes
+
+    @smart_inference_mode()
+    def detect_batch(self, ims, timings: dict | None = None, imgsz: int | None = None):
+        """
+        Run the resident model on a list of BGR images in a single forward pass, at inference
+        size `imgsz` (stride-aligned, default size if None).
+        When `timings` is given, the preprocess, inference and nms durations (seconds) are stored in it.
+
+        Returns:
+            list of (n, 6) tensors of [x1, y1, x2, y2, conf, cls] in original image pixels.
+        """
+        dt = (Profile(), Profile(), Profile())
+        with dt[0]:
+            im, shapes = self.preprocess(ims, imgsz)
+        with self._lock, dt[1]:
+            pred = self.model(im)
+        with dt[2]:
+            pred = non_max_suppression(
+                pred, self.conf_thres, self.iou_thres, self.classes, max_det=self.max_det, method=self.nms
+            )
+            for det, (shape0, ratio_pad) in zip(pred, shapes):
+                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], shape0, ratio_pad).round()
+        if timings is not None:
+            timings.update(preprocess=dt[0].dt, inference=dt[1].dt, nms=dt[2].dt)
+        return pred
+
+    def detect(self, im0):
+        """Run the resident model on a single BGR image."""
+        return self.detect_batch([im0])[0]
+
+    @smart_inference_mode()
+    def detect_tiled(self, im0, timings: dict | None = None):
+        """
+        Run sliced inference on a single large BGR image: overlapping tiles of the
+        model input size are batched through the model and merged across seams.
+        When `timings` is given, the whole tiled pass is stored in it as tiled_inference.
+        """
+        dt = Profile()
+        with self._lock, dt:
+            det = tiled_inference(
+                self.model,
+                im0,
+                tile=self.imgsz,
+                overlap=self.tile_overlap,
+                batch_size=self.tile_batch_size,
+                conf_thres=self.conf_thres,
+                iou_thres=self.iou_thres,
+                classes=self.classes,
+                max_det=self.max_det,
+                merge=self.tile_merge,
+                full_imgsz=self.tile_full_imgsz,
+                nms=self.nms,
+            ).round()
+        if timings is not None:
+            timings["tiled_inference"] = dt.dt
+        return det
@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import os
+import re
+import time
+from collections import OrderedDict
+
+MODEL_NAME = re.compile(r"^[\w.-]+$")
+
+
+class UnknownModelError(ValueError):
+    """The requested model name is not in the registry."""
+
+
+def parse_models(spec: str) -> dict[str, str]:
+    """Parse "name=weights,name=weights" into {name: weights path}."""
+    models = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, sep, weights = item.partition("=")
+        name, weights = name.strip(), weights.strip()
+        if not sep or not MODEL_NAME.match(name) or not weights:
+            raise ValueError(f"Invalid model entry '{item}', expected name=weights")
+        models[name] = weights
+    if not models:
+        raise ValueError("No models configured")
+    return models
+
+
+class ModelEntry:
+    def __init__(self, name: str, weights: str):
+        self.name = name
+        self.weights = weights
+        self.value = None  # whatever `load` returned, None while unloaded
+        self.nbytes = 0
+        self.users = 0  # requests currently using the model, never evicted while > 0
+        self.loading = None  # asyncio task while the model loads
+        self.load_seconds = None  # duration of the last load
+
+
+class ModelRegistry:
+    """
+    Named models loaded on first use and evicted least recently used first.
+
+    `load(name, weights)` runs in a thread and returns `(value, nbytes)`,
+    where `value` is what requests get from `use` and `nbytes` is the memory the
+    model holds. `unload(value)` releases it. Concurrent first requests share
+    one load. When `memory_budget` (bytes, 0 for unlimited) would be exceeded,
+    idle models are unloaded oldest first; models in use are never evicted, so
+    the budget is a target rather than a hard limit.
+    """
+
+    def __init__(self, models: dict[str, str], default: str, load, unload, memory_budget: int = 0):
+        if default not in models:
+            raise ValueError(f"Default model '{default}' is not one of {list(models)}")
+        self.default = default
+        self.load = load
+        self.unload = unload
+        self.memory_budget = memory_budget
+        self._entries = {name: ModelEntry(name, weights) for name, weights in models.items()}
+        self._loaded: OrderedDict[str, ModelEntry] = OrderedDict()  # least recently used first
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._entries)
+
+    def resolve(self, name: str | None) -> ModelEntry:
+        entry = self._entries.get(name or self.default)
+        if entry is None:
+            raise UnknownModelError(f"Unknown model '{name}', available models: {', '.join(self._entries)}")
+        return entry
+
+    def loaded(self) -> dict:
+        """{name: value} of the loaded models, least recently used first."""
+        return {name: entry.value for name, entry in self._loaded.items()}
+
+    @contextlib.asynccontextmanager
+    async def use(self, name: str | None = None):
+        """Yield the loaded model `name` (default model if None), loading it first if needed."""
+        entry = self.resolve(name)
+        entry.users += 1  # pinned before any await, so it cannot be evicted under us
+        try:
+            while entry.value is None:
+                if entry.loading is None:
+                    entry.loading = asyncio.create_task(self._load(entry))
+                await asyncio.shield(entry.loading)
+            self._loaded.move_to_end(entry.name)
+            yield entry.value
+        finally:
+            entry.users -= 1
+
+    async def preload(self, name: str | None = None):
+        async with self.use(name):
+            pass
+
+    async def close(self):
+        for entry in list(self._loaded.values()):
+            await self._unload(entry)
+
+    def stats(self) -> dict:
+        return {
+            "default": self.default,
+            "memory_budget": self.memory_budget,
+            "memory_used": sum(entry.nbytes for entry in self._loaded.values()),
+            "models": {
+                entry.name: {
+                    "weights": entry.weights,
+                    "loaded": entry.value is not None,
+                    "nbytes": entry.nbytes,
+                    "in_use": entry.users,
+                    "load_seconds": entry.load_seconds,
+                }
+                for entry in self._entries.values()
+            },
+        }
+
+    async def _load(self, entry):
+        try:
+            # Make room using the file size as estimate, then again with the measured size
+            await self._make_room(self._file_size(entry.weights))
+            start = time.perf_counter()
+            value, nbytes = await asyncio.to_thread(self.load, entry.name, entry.weights)
+            entry.value, entry.nbytes, entry.load_seconds = value, nbytes, time.perf_counter() - start
+            self._loaded[entry.name] = entry
+            await self._make_room(0)
+        finally:
+            entry.loading = None
+
+    async def _make_room(self, needed: int):
+        if not self.memory_budget:
+            return
+        used = sum(entry.nbytes for entry in self._loaded.values())
+        for entry in list(self._loaded.values()):
+            if used + needed <= self.memory_budget:
+                break
+            if entry.users or entry.name not in self._loaded:  # busy, or unloaded meanwhile
+                continue
+            used -= entry.nbytes
+            await self._unload(entry)
+
+    async def _unload(self, entry):
+        # Detach synchronously so new requests reload instead of using a closing model
+        value = entry.value
+        self._loaded.pop(entry.name, None)
+        entry.value, entry.nbytes = None, 0
+        await asyncio.to_thread(self.unload, value)
+
+    @staticmethod
+    def _file_size(path) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
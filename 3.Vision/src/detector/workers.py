@@ -0,0 +1,255 @@
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+
+MIN_SLOT_BYTES = 4 * 1024 * 1024  # initial shared-memory buffer per dispatching thread
+RESTART_BACKOFF = 1.0  # seconds before replacing a crashed worker, doubled for each consecutive failure
+MAX_RESTART_BACKOFF = 60.0
+MAX_RESTARTS = 5  # consecutive failed replacements before a worker is given up
+
+
+def _run_task(detector, shm, layout, tiled, imgsz):
+    # Views into shared memory must not outlive this call, so the segment can be closed later
+    ims = [np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset) for offset, shape in layout]
+    timings = {}
+    if tiled:
+        dets = [detector.detect_tiled(im, timings) for im in ims]
+    else:
+        dets = detector.detect_batch(ims, timings, imgsz=imgsz)
+    return [det.cpu().numpy() for det in dets], timings
+
+
+def _worker_main(rank, detector_kwargs, num_threads, tasks, results):
+    from detector.model import YoloDetector
+
+    torch.set_num_threads(num_threads)
+    intra, inter = detector_kwargs.get("ort_threads", (0, 0))
+    detector = YoloDetector(**{**detector_kwargs, "ort_threads": (intra or num_threads, inter)})
+    ready = {
+        "imgsz": detector.imgsz,
+        "names": detector.names,
+        "nbytes": detector.nbytes,
+        "cost_profile": detector.cost_profile,
+    }
+    results.put((None, rank, ready))
+
+    buffers = {}  # slot -> attached SharedMemory
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, slot, name, size, layout, tiled, imgsz = task
+        try:
+            shm = buffers.get(slot)
+            if shm is None or shm.name != name or shm.size != size:  # new or regrown slot
+                if shm is not None:
+                    shm.close()
+                # Spawned workers share the front-end's resource tracker, which owns the segment
+                shm = buffers[slot] = shared_memory.SharedMemory(name=name)
+            results.put((task_id, rank, _run_task(detector, shm, layout, tiled, imgsz)))
+        except Exception as e:
+            results.put((task_id, rank, RuntimeError(f"{type(e).__name__}: {e}")))
+
+    for shm in buffers.values():
+        shm.close()
+
+
+class InferencePool:
+    """
+    Pool of inference worker processes, each holding its own resident model.
+
+    Every worker runs a `YoloDetector` with `threads_per_worker` torch threads
+    (and ONNX Runtime intra-op threads, unless set in `ort_threads`), so several processes can use all cores without contending for one GIL.
+    `detect_batch` has the same interface as `YoloDetector.detect_batch`: the
+    decoded images are copied into a shared-memory buffer owned by the calling
+    thread (no pickling of pixel data), the batch is sent to the least busy
+    worker and the small detection arrays come back over a result queue.
+    A crashed worker fails its pending batches and is replaced after a backoff;
+    after `MAX_RESTARTS` failed replacements in a row it is given up, and once
+    every worker is, batches raise instead of waiting.
+    """
+
+    def __init__(self, detector_kwargs: dict, workers: int = 2, threads_per_worker: int = 0):
+        self.detector_kwargs = detector_kwargs
+        self.workers = max(1, workers)
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        self._ctx = mp.get_context("spawn")  # fork is unsafe with torch threads
+        self._results = self._ctx.Queue()
+        self._processes = [None] * self.workers
+        self._tasks = [self._ctx.Queue() for _ in range(self.workers)]
+        self._ready = [threading.Event() for _ in range(self.workers)]
+        self._inflight = [{} for _ in range(self.workers)]  # rank -> {task_id: Future}
+        self._lock = threading.Lock()
+        self._task_ids = itertools.count()
+        self._slot_ids = itertools.count()
+        self._local = threading.local()
+        self._segments = []  # every SharedMemory created, unlinked on close
+        self._closed = False
+        self._started = False
+        self._startup_error = None
+        self._failures = [0] * self.workers  # consecutive crashes, reset when a replacement is ready
+        self._restart_at = [None] * self.workers  # monotonic time a crashed worker is replaced
+        self._failed = [None] * self.workers  # error of a worker given up after MAX_RESTARTS
+        self.imgsz = self.names = self.cost_profile = None
+        self._nbytes = [0] * self.workers
+
+        for rank in range(self.workers):
+            self._spawn(rank)
+        self._listener = threading.Thread(target=self._listen, name="inference-pool", daemon=True)
+        self._listener.start()
+        for event in self._ready:
+            event.wait()
+        if self._startup_error:
+            self.close()
+            raise RuntimeError(self._startup_error)
+        self._started = True
+
+    @property
+    def nbytes(self) -> int:
+        """Model memory across all workers, each holding its own copy."""
+        return sum(self._nbytes)
+
+    def detect_batch(self, ims, timings: dict | None = None, imgsz: int | None = None) -> list[torch.Tensor]:
+        """Run a batch of BGR images on a worker process; blocks until its detections are back."""
+        return self._dispatch(ims, tiled=False, timings=timings, imgsz=imgsz)
+
+    def detect_tiled(self, im0, timings: dict | None = None) -> torch.Tensor:
+        """Run sliced inference on one large BGR image on a worker process."""
+        return self._dispatch([im0], tiled=True, timings=timings)[0]
+
+    def _dispatch(self, ims, tiled, timings, imgsz=None):
+        ims = [np.ascontiguousarray(im) for im in ims]
+        layout, nbytes = [], 0
+        for im in ims:
+            layout.append((nbytes, im.shape))
+            nbytes += im.nbytes
+        slot, shm = self._slot(nbytes)
+        for im, (offset, shape) in zip(ims, layout):
+            np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)[:] = im
+
+        future = Future()
+        task_id = next(self._task_ids)
+        with self._lock:
+            alive = [r for r in range(self.workers) if self._failed[r] is None]
+            if not alive:
+                raise RuntimeError(self._failed[0])
+            ready = [r for r in alive if self._ready[r].is_set()] or alive
+            rank = min(ready, key=lambda r: len(self._inflight[r]))  # least busy worker
+            self._inflight[rank][task_id] = future
+            self._tasks[rank].put((task_id, slot, shm.name, shm.size, layout, tiled, imgsz))
+        dets, stage_timings = future.result()
+        if timings is not None:  # stages measured inside the worker
+            timings.update(stage_timings)
+        return [torch.from_numpy(det) for det in dets]
+
+    def close(self):
+        self._closed = True
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self._listener.join()
+        for shm in self._segments:
+            shm.close()
+            shm.unlink()
+
+    def _slot(self, nbytes):
+        # Each dispatching thread reuses its own buffer and slot id, regrowing the buffer when a batch does not fit
+        local = self._local
+        shm = getattr(local, "shm", None)
+        if shm is None or shm.size < nbytes:
+            old, shm = shm, shared_memory.SharedMemory(create=True, size=max(MIN_SLOT_BYTES, 2 * nbytes))
+            with self._lock:
+                self._segments.append(shm)
+                if old is not None:
+                    self._segments.remove(old)
+            if old is not None:
+                old.close()
+                old.unlink()  # workers still attached keep their mapping until they switch
+            else:
+                local.slot = next(self._slot_ids)
+            local.shm = shm
+        return local.slot, shm
+
+    def _spawn(self, rank):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(rank, self.detector_kwargs, self.threads_per_worker, self._tasks[rank], self._results),
+            name=f"inference-worker-{rank}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[rank] = process
+
+    def _listen(self):
+        last_check = time.monotonic()
+        while True:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                if self._closed:
+                    return
+                message = None
+            if not self._closed and time.monotonic() - last_check > 1.0:
+                self._check_workers()
+                last_check = time.monotonic()
+            if message is not None:
+                self._handle(*message)
+
+    def _handle(self, task_id, rank, payload):
+        if task_id is None:  # worker finished loading its model
+            self.imgsz, self.names, self.cost_profile = payload["imgsz"], payload["names"], payload["cost_profile"]
+            self._nbytes[rank] = payload["nbytes"]
+            self._failures[rank] = 0
+            self._ready[rank].set()
+            return
+        with self._lock:
+            future = self._inflight[rank].pop(task_id, None)
+        if future is None:
+            return
+        if isinstance(payload, Exception):
+            future.set_exception(payload)
+        else:
+            future.set_result(payload)
+
+    def _check_workers(self):
+        # Fail the batches of a crashed worker and start a replacement after a backoff, doubled for each consecutive
+        # crash. A worker whose replacements keep failing (e.g. to load the model) is given up after MAX_RESTARTS
+        now = time.monotonic()
+        for rank, process in enumerate(self._processes):
+            if self._failed[rank] is not None or process.is_alive():
+                continue
+            if not self._started:  # failed while loading the model, do not retry forever
+                self._startup_error = f"Inference worker {rank} failed to start (exit code {process.exitcode})"
+                for event in self._ready:
+                    event.set()
+                return
+            if self._restart_at[rank] is None:  # crash not handled yet
+                error = f"Inference worker {rank} exited with code {process.exitcode}"
+                self._failures[rank] += 1
+                give_up = self._failures[rank] > MAX_RESTARTS
+                with self._lock:  # batches dispatched from now on wait in the replacement's queue
+                    lost, self._inflight[rank] = self._inflight[rank], {}
+                    self._ready[rank].clear()
+                    self._tasks[rank] = self._ctx.Queue()
+                    if give_up:
+                        self._failed[rank] = f"{error}, given up after {MAX_RESTARTS} failed restarts"
+                for future in lost.values():
+                    future.set_exception(RuntimeError(self._failed[rank] or error))
+                if give_up:
+                    continue
+                backoff = min(RESTART_BACKOFF * 2 ** (self._failures[rank] - 1), MAX_RESTART_BACKOFF)
+                self._restart_at[rank] = now + backoff
+            if now >= self._restart_at[rank]:
+                self._restart_at[rank] = None
+                self._spawn(rank)
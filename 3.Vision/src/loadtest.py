@@ -0,0 +1,384 @@
+"""
+Load test for the detection API.
+
+Serves a directory of images from a local stub HTTP server and drives the
+service with them, either with a fixed number of concurrent clients (closed
+loop) or at a fixed arrival rate (open loop, Poisson arrivals). Reports
+throughput, latency percentiles, error/timeout rates and the service's RSS as
+JSON, so runs can be diffed between commits.
+
+Usage:
+    python loadtest.py --images ./imgs --spawn --concurrency 8 --duration 60 --output run.json
+    python loadtest.py --images ./imgs --url http://localhost:8000 --pid 1234 --mode upload --rate 20
+    python loadtest.py --images ./imgs --url http://localhost:8000 --mode batch --batch-images 16
+"""
+
+import argparse
+import asyncio
+import functools
+import http.server
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import numpy as np
+import psutil
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+TIMEOUT_MESSAGE = "failed to respond within the time limit"  # service answer when DETECTION_TIMEOUT is exceeded
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ImageCorpus:
+    """
+    Images loaded once into memory. With `unique`, every draw gets a distinct
+    counter appended after the end of the image data: decoders ignore it but the
+    bytes differ, so the service's content cache never answers from memory.
+    """
+
+    def __init__(self, directory: str, unique: bool = True):
+        paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(IMAGE_SUFFIXES)
+        )
+        if not paths:
+            raise SystemExit(f"No images found in {directory}")
+        self.names = [os.path.basename(p) for p in paths]
+        self.images = {}
+        for name, path in zip(self.names, paths):
+            with open(path, "rb") as f:
+                self.images[name] = f.read()
+        self.unique = unique
+        self._counter = itertools.count()
+        self._cycle = itertools.cycle(self.names)
+        self._lock = threading.Lock()
+
+    def next_name(self) -> str:
+        with self._lock:
+            return next(self._cycle)
+
+    def content(self, name: str) -> bytes:
+        data = self.images[name]
+        if self.unique:
+            with self._lock:
+                n = next(self._counter)
+            data += f"\n#{n}".encode()
+        return data
+
+
+class ImageServer:
+    """Stub HTTP server publishing the corpus on 127.0.0.1, threaded so downloads run in parallel."""
+
+    def __init__(self, corpus: ImageCorpus, port: int = 0):
+        handler = functools.partial(_ImageHandler, corpus)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="image-server", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _ImageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like a real image host
+
+    def __init__(self, corpus, *args, **kwargs):
+        self.corpus = corpus
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        name = self.path.split("?")[0].lstrip("/")
+        if name not in self.corpus.images:
+            self.send_error(404)
+            return
+        data = self.corpus.content(name)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class RssSampler:
+    """Samples the resident memory of a process and its children (e.g. inference workers)."""
+
+    def __init__(self, pid: int | None, interval: float = 0.5):
+        self.process = psutil.Process(pid) if pid else None
+        self.interval = interval
+        self.samples = []
+
+    def sample(self):
+        if self.process is None:
+            return
+        try:
+            processes = [self.process] + self.process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        rss = 0
+        for p in processes:
+            try:
+                rss += p.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.samples.append(rss)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def summary(self) -> dict | None:
+        if not self.samples:
+            return None
+        mb = np.array(self.samples) / 2**20
+        return {"start_mb": round(mb[0], 1), "peak_mb": round(mb.max(), 1), "end_mb": round(mb[-1], 1)}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []  # seconds, successful requests only
+        self.statuses = {}
+        self.ok = self.errors = self.timeouts = self.images = 0
+        self.recording = False
+
+    def record(self, latency: float, status: str, ok: bool, timeout: bool = False, images: int = 1):
+        if not self.recording:  # warmup
+            return
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if timeout:
+            self.timeouts += 1
+        elif ok:
+            self.ok += 1
+            self.images += images
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+
+async def detect_get(client, opt, corpus, server):
+    response = await client.get("/detection", params={"image_url": f"{server.base_url}/{corpus.next_name()}"})
+    return response, 1
+
+
+async def detect_upload(client, opt, corpus, server):
+    name = corpus.next_name()
+    response = await client.post("/detection", content=corpus.content(name), headers={"Content-Type": "image/jpeg"})
+    return response, 1
+
+
+async def detect_batch(client, opt, corpus, server):
+    urls = [f"{server.base_url}/{corpus.next_name()}" for _ in range(opt.batch_images)]
+    response = await client.post("/detection/batch", json={"image_urls": urls})
+    return response, opt.batch_images
+
+
+MODES = {"get": detect_get, "upload": detect_upload, "batch": detect_batch}
+
+
+def classify(response, images) -> tuple[str, bool, bool]:
+    # -> (status label, ok, timed out); batch responses are NDJSON with one result per image
+    status = str(response.status_code)
+    if response.status_code != 200:
+        return status, False, False
+    lines = response.text.splitlines() if images > 1 else [response.text]
+    results = [json.loads(line) for line in lines if line]
+    if any(TIMEOUT_MESSAGE in r.get("message", "") for r in results):
+        return "timeout", False, True
+    if len(results) != images or any(r.get("detections") is None for r in results):
+        return "partial", False, False
+    return status, True, False
+
+
+async def one_request(client, opt, corpus, server, recorder):
+    start = time.perf_counter()
+    try:
+        response, images = await MODES[opt.mode](client, opt, corpus, server)
+        status, ok, timeout = classify(response, images)
+    except httpx.TimeoutException:
+        status, ok, timeout, images = "timeout", False, True, 0
+    except httpx.HTTPError as e:
+        status, ok, timeout, images = type(e).__name__, False, False, 0
+    recorder.record(time.perf_counter() - start, status, ok, timeout, images)
+
+
+async def closed_loop(client, opt, corpus, server, recorder, deadline):
+    # `concurrency` clients, each sending its next request as soon as the previous one returns
+    async def client_loop():
+        while time.perf_counter() < deadline():
+            await one_request(client, opt, corpus, server, recorder)
+
+    await asyncio.gather(*(client_loop() for _ in range(opt.concurrency)))
+
+
+async def open_loop(client, opt, corpus, server, recorder, deadline):
+    # Poisson arrivals at `rate` per second, independent of how fast the service answers
+    limit = asyncio.Semaphore(opt.max_in_flight)
+    tasks = set()
+
+    async def fire():
+        async with limit:
+            await one_request(client, opt, corpus, server, recorder)
+
+    rng = random.Random(opt.seed)
+    next_at = time.perf_counter()
+    while next_at < deadline():
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        task = asyncio.create_task(fire())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        next_at += rng.expovariate(opt.rate)
+    await asyncio.gather(*tasks)
+
+
+def percentiles(latencies) -> dict:
+    if not latencies:
+        return {}
+    ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "mean": round(ms.mean(), 2),
+        "p50": round(p50, 2),
+        "p95": round(p95, 2),
+        "p99": round(p99, 2),
+        "max": round(ms.max(), 2),
+    }
+
+
+def spawn_service(opt, port):
+    # Start the API with uvicorn in its own process, next to this file, and wait for the model to load
+    env = dict(os.environ, **dict(kv.split("=", 1) for kv in opt.env))
+    cmd = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    process = subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + opt.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Service exited during startup with code {process.returncode}")
+        try:
+            if httpx.get(f"{url}/cache/stats", timeout=1.0).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise SystemExit(f"Service did not start within {opt.startup_timeout}s")
+
+
+async def run_load(opt, url, pid, corpus, server) -> dict:
+    recorder = Recorder()
+    sampler = RssSampler(pid)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=url, timeout=opt.timeout, limits=limits) as client:
+        sampler_task = asyncio.create_task(sampler.run())
+        drive = open_loop if opt.rate else closed_loop
+        if opt.warmup > 0:
+            end = time.perf_counter() + opt.warmup
+            await drive(client, opt, corpus, server, recorder, lambda: end)
+        recorder.recording = True
+        start = time.perf_counter()
+        end = start + opt.duration
+        await drive(client, opt, corpus, server, recorder, lambda: end)
+        elapsed = time.perf_counter() - start
+        sampler.sample()
+        sampler_task.cancel()
+
+    total = recorder.ok + recorder.errors + recorder.timeouts
+    return {
+        "config": {
+            "mode": opt.mode,
+            "concurrency": None if opt.rate else opt.concurrency,
+            "rate": opt.rate or None,
+            "duration_s": opt.duration,
+            "warmup_s": opt.warmup,
+            "batch_images": opt.batch_images if opt.mode == "batch" else None,
+            "corpus_images": len(corpus.names),
+            "unique": corpus.unique,
+            "env": opt.env,
+        },
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "requests": total,
+        "ok": recorder.ok,
+        "errors": recorder.errors,
+        "timeouts": recorder.timeouts,
+        "error_rate": round(recorder.errors / total, 4) if total else 0.0,
+        "timeout_rate": round(recorder.timeouts / total, 4) if total else 0.0,
+        "statuses": dict(sorted(recorder.statuses.items())),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(recorder.ok / elapsed, 2),
+        "images_per_s": round(recorder.images / elapsed, 2),
+        "latency_ms": percentiles(recorder.latencies),
+        "rss": sampler.summary(),
+    }
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser(description="Load test for the detection API")
+    parser.add_argument("--images", required=True, help="directory of images served by the stub image server")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of a running service")
+    parser.add_argument("--spawn", action="store_true", help="start the service locally instead of using --url")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for the spawned service, repeatable")
+    parser.add_argument("--pid", type=int, default=None, help="PID of a running service, to report its RSS")
+    parser.add_argument("--mode", default="get", choices=list(MODES), help="GET by URL, POST upload or batch")
+    parser.add_argument("--batch-images", type=int, default=8, help="images per /detection/batch call")
+    parser.add_argument("--concurrency", type=int, default=8, help="closed loop: concurrent clients")
+    parser.add_argument("--rate", type=float, default=0.0, help="open loop: requests per second (overrides --concurrency)")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="open loop: cap on outstanding requests")
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="unmeasured seconds before the run")
+    parser.add_argument("--timeout", type=float, default=60.0, help="client timeout per request in seconds")
+    parser.add_argument("--startup-timeout", type=float, default=300.0, help="seconds to wait for a spawned service")
+    parser.add_argument("--repeat-content", action="store_true", help="send identical bytes so the result cache can hit")
+    parser.add_argument("--seed", type=int, default=0, help="arrival process seed")
+    parser.add_argument("--output", default="", help="write the JSON report to this file as well as stdout")
+    return parser.parse_args()
+
+
+def main(opt):
+    corpus = ImageCorpus(opt.images, unique=not opt.repeat_content)
+    server = ImageServer(corpus)
+    server.start()
+    service, url, pid = None, opt.url, opt.pid
+    try:
+        if opt.spawn:
+            service, url = spawn_service(opt, free_port())
+            pid = service.pid
+        report = asyncio.run(run_load(opt, url, pid, corpus, server))
+    finally:
+        server.stop()
+        if service is not None:
+            service.terminate()
+            service.wait(timeout=30)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if opt.output:
+        with open(opt.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main(parse_opt())
@@ -5,6 +5,7 @@ import time
 from pathlib import Path
 
 import pandas as pd
+import torch
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]  # YOLO root directory
@@ -14,10 +15,13 @@ if str(ROOT) not in sys.path:
 
 import export
 from models.experimental import attempt_load
-from models.yolo import SegmentationModel
+from models.yolo import DetectionModel, SegmentationModel
 from segment.val import run as val_seg
 from utils import notebook_init
-from utils.general import LOGGER, check_yaml, file_size, print_args
+from utils.general import LOGGER, check_yaml, file_size, non_max_suppression, print_args
+from utils.metrics import box_iou
+from utils.nms import NMS_METHODS
+from utils.optimize import OPTIMIZE_MODES, OptimizedModel
 from utils.torch_utils import select_device
 from val import run as val_det
 
@@ -116,6 +120,99 @@ def test(
     return py
 
 
+def nms_speed(
+        candidates=(1000, 10000, 30000),  # candidate boxes per image
+        batch_size=1,  # batch size
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        conf_thres=0.001,  # confidence threshold
+        iou_thres=0.7,  # NMS IoU threshold
+        max_det=300,  # maximum detections per image
+        runs=3,  # timed runs, the fastest is reported
+):
+    # Time each NMS method on synthetic crowded scenes (clusters of 10 overlapping candidates per object)
+    # Agreement is the share of greedy NMS detections matched by a same-class detection at IoU > 0.9
+    y, t = [], time.time()
+    device = select_device(device)
+    nc = 80
+    ref = {}
+    for n in candidates:
+        c = torch.rand(batch_size, 2, n // 10, 1, device=device) * 1280  # object centers
+        xy = (c + torch.randn(batch_size, 2, n // 10, 10, device=device) * 4).view(batch_size, 2, -1)
+        wh = (torch.rand(batch_size, 2, n // 10, 1, device=device) * 60 + 20).expand(-1, -1, -1, 10).reshape(xy.shape)
+        cls = torch.zeros(batch_size, nc, xy.shape[2], device=device)
+        cls.scatter_(1, torch.randint(0, nc, (batch_size, 1, xy.shape[2]), device=device),
+                     torch.rand(batch_size, 1, xy.shape[2], device=device) * 0.9 + 0.05)
+        pred = torch.cat((xy, wh, cls), 1)
+        for method in NMS_METHODS:
+            dt = []
+            for _ in range(runs):
+                t0 = time.perf_counter()
+                out = non_max_suppression(pred, conf_thres, iou_thres, max_det=max_det, method=method)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                dt.append(time.perf_counter() - t0)
+            if method == 'nms':
+                ref[n] = out
+            agree = [((box_iou(r[:, :4], o[:, :4]) > 0.9) & (r[:, 5:6] == o[:, 5])).any(1).float().mean().item()
+                     if len(r) and len(o) else float(len(r) == len(o)) for r, o in zip(ref[n], out)]
+            ms = min(dt) * 1E3 / batch_size
+            y.append([method, n, round(ms, 2), sum(map(len, out)) / batch_size, round(sum(agree) / len(agree), 3)])
+
+    # Print results
+    py = pd.DataFrame(y, columns=['Method', 'Candidates', 'Time per image (ms)', 'Detections', 'Agreement'])
+    LOGGER.info(f'\nNMS benchmarks complete ({time.time() - t:.2f}s)')
+    LOGGER.info(str(py))
+    return py
+
+
+def optimize_speed(
+        cfgs=sorted((ROOT / 'models/detect').glob('*.yaml')),  # model families
+        imgsz=640,  # inference size (pixels)
+        batch_size=1,  # batch size
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        modes=OPTIMIZE_MODES,  # optimized inference modes, compared with eager
+        runs=3,  # timed runs, the fastest is reported
+):
+    # Time eager and optimized PyTorch inference (utils/optimize.py) of each model family, randomly initialized
+    # Build is the time to build and check the optimized model of the input shape, before the timed runs
+    y, t = [], time.time()
+    device = select_device(device)
+    for cfg in map(Path, cfgs):
+        try:
+            model = DetectionModel(cfg).to(device).fuse().eval()
+            model.half() if half else model.float()
+        except Exception as e:
+            LOGGER.warning(f'WARNING ⚠️ Benchmark failure for {cfg.name}: {e}')
+            continue
+        im = torch.rand(batch_size, 3, imgsz, imgsz, device=device).to(torch.half if half else torch.float)
+        for mode in ('eager', *modes):  # eager first, optimized modes convert the model to channels_last
+            try:
+                with torch.inference_mode():
+                    t0 = time.perf_counter()
+                    fn = model if mode == 'eager' else OptimizedModel(model, mode)
+                    fn(im)  # build and check
+                    build = time.perf_counter() - t0
+                    dt = []
+                    for _ in range(runs):
+                        t0 = time.perf_counter()
+                        fn(im)
+                        if device.type == 'cuda':
+                            torch.cuda.synchronize()
+                        dt.append(time.perf_counter() - t0)
+                ms = min(dt) * 1E3
+                y.append([cfg.stem, mode, round(build, 1), round(ms, 1), round(batch_size * 1E3 / ms, 2)])
+            except Exception as e:
+                LOGGER.warning(f'WARNING ⚠️ Benchmark failure for {cfg.name} {mode}: {e}')
+                y.append([cfg.stem, mode, None, None, None])
+
+    # Print results
+    py = pd.DataFrame(y, columns=['Model', 'Mode', 'Build (s)', 'Inference time (ms)', 'Images/s'])
+    LOGGER.info(f'\nOptimized inference benchmarks complete ({time.time() - t:.2f}s)')
+    LOGGER.info(str(py))
+    return py
+
+
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', type=str, default=ROOT / 'yolo.pt', help='weights path')
@@ -127,6 +224,8 @@ def parse_opt():
     parser.add_argument('--test', action='store_true', help='test exports only')
     parser.add_argument('--pt-only', action='store_true', help='test PyTorch only')
     parser.add_argument('--hard-fail', nargs='?', const=True, default=False, help='Exception on error or < min metric')
+    parser.add_argument('--nms', action='store_true', help='benchmark NMS methods only, on synthetic crowded scenes')
+    parser.add_argument('--optimize', nargs='*', choices=OPTIMIZE_MODES, help='benchmark optimized inference modes')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     print_args(vars(opt))
@@ -134,7 +233,14 @@ def parse_opt():
 
 
 def main(opt):
-    test(**vars(opt)) if opt.test else run(**vars(opt))
+    optimize = vars(opt).pop('optimize')
+    if vars(opt).pop('nms'):
+        nms_speed(batch_size=opt.batch_size, device=opt.device)
+    elif optimize is not None:  # all modes when none is given
+        optimize_speed(imgsz=opt.imgsz, batch_size=opt.batch_size, device=opt.device, half=opt.half,
+                       modes=optimize or OPTIMIZE_MODES)
+    else:
+        test(**vars(opt)) if opt.test else run(**vars(opt))
 
 
 if __name__ == "__main__":
@@ -13,10 +13,15 @@ if str(ROOT) not in sys.path:
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
+from utils import BackgroundSink
+from utils.augmentations import to_tensor
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
 from utils.plots import Annotator, colors, save_one_box
+from utils.nms import NMS_METHODS
+from utils.optimize import OPTIMIZE_MODES
+from utils.tiling import tiled_inference
 from utils.torch_utils import select_device, smart_inference_mode
 
 
@@ -37,6 +42,7 @@ def run(
         nosave=False,  # do not save images/videos
         classes=None,  # filter by class: --class 0, or --class 0 2 3
         agnostic_nms=False,  # class-agnostic NMS
+        nms='nms',  # suppression method: nms, cluster, cluster-merge or matrix
         augment=False,  # augmented inference
         visualize=False,  # visualize features
         update=False,  # update all models
@@ -48,7 +54,18 @@ def run(
         hide_conf=False,  # hide confidences
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
+        optimize=None,  # optimized PyTorch inference: channels_last, jit or compile
+        optimize_cache=None,  # directory keeping optimized models (jit traces, kernels, ONNX graphs) for later runs
+        ort_threads=(0, 0),  # ONNX Runtime intra-op and inter-op threads, 0 for defaults
         vid_stride=1,  # video frame-rate stride
+        batch_size=1,  # images per forward pass for image files, in batches of similar aspect ratio
+        workers=4,  # threads decoding the next image files during inference, 0 to decode on demand
+        reduced_decode=False,  # decode large JPEGs at reduced resolution (results and saved images at that resolution)
+        tile=0,  # tiled inference tile size (pixels), 0 to disable
+        tile_overlap=0.2,  # overlap between neighbouring tiles (fraction of tile size)
+        tile_batch=8,  # tiles per forward pass
+        tile_merge='nms',  # merge detections across tile seams: nms or wbf
+        tile_full=0,  # inference size of an extra full-image pass in tiled mode, 0 to disable
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -65,51 +82,121 @@ def run(
 
     # Load model
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    model = DetectMultiBackend(weights,
+                               device=device,
+                               dnn=dnn,
+                               data=data,
+                               fp16=half,
+                               optimize=optimize,
+                               cache_dir=optimize_cache,
+                               ort_threads=ort_threads)
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    if tile:
+        tile = check_img_size(tile, s=stride)  # check tile size
 
     # Dataloader
     bs = 1  # batch_size
     if webcam:
         view_img = check_imshow(warn=True)
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride, hwc=True)
         bs = len(dataset)
     elif screenshot:
         dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        reduced = reduced_decode and not tile  # tiles need the full resolution
+        batch_size = 1 if tile or visualize else batch_size  # tiles are batched per image
+        dataset = LoadImages(source,
+                             img_size=imgsz,
+                             stride=stride,
+                             auto=pt,
+                             vid_stride=vid_stride,
+                             reduced=reduced,
+                             batch_size=batch_size,
+                             workers=workers,
+                             hwc=True)
+        bs = batch_size
     vid_path, vid_writer = [None] * bs, [None] * bs
 
+    # Results sink: annotation, crops, label files and image/video encoding run on a background thread
+    def write_results(p, im0, det, i, save_path, txt_path, mode, vid_info):
+        gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+        imc = im0.copy() if save_crop else im0  # for save_crop
+        annotator = Annotator(im0, line_width=line_thickness, example=str(names))
+        for *xyxy, conf, cls in reversed(det):
+            if save_txt:  # Write to file
+                xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+                with open(f'{txt_path}.txt', 'a') as f:
+                    f.write(('%g ' * len(line)).rstrip() % line + '\n')
+
+            if save_img or save_crop or view_img:  # Add bbox to image
+                c = int(cls)  # integer class
+                label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
+                annotator.box_label(xyxy, label, color=colors(c, True))
+            if save_crop:
+                save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
+
+        # Stream results
+        im0 = annotator.result()
+        if view_img:
+            if platform.system() == 'Linux' and p not in windows:
+                windows.append(p)
+                cv2.namedWindow(str(p), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)  # allow window resize (Linux)
+                cv2.resizeWindow(str(p), im0.shape[1], im0.shape[0])
+            cv2.imshow(str(p), im0)
+            cv2.waitKey(1)  # 1 millisecond
+
+        # Save results (image with detections)
+        if save_img:
+            if mode == 'image':
+                cv2.imwrite(save_path, im0)
+            else:  # 'video' or 'stream'
+                if vid_path[i] != save_path:  # new video
+                    vid_path[i] = save_path
+                    if isinstance(vid_writer[i], cv2.VideoWriter):
+                        vid_writer[i].release()  # release previous video writer
+                    fps, w, h = vid_info or (30, im0.shape[1], im0.shape[0])  # video, else stream
+                    save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
+                    vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                vid_writer[i].write(im0)
+
+    sink = BackgroundSink(write_results, maxsize=2 * bs + 2, threaded=not view_img)  # windows stay on this thread
+
     # Run inference
     model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
     seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
     for path, im, im0s, vid_cap, s in dataset:
+        batched = isinstance(im0s, list)  # streams, or image files with --batch-size
         with dt[0]:
-            im = torch.from_numpy(im).to(model.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
+            im = to_tensor(im, model.device, model.fp16, bgr_hwc=not screenshot)  # uint8 to fp16/32, 0.0 - 1.0
             if len(im.shape) == 3:
                 im = im[None]  # expand for batch dim
 
         # Inference
         with dt[1]:
             visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-            pred = model(im, augment=augment, visualize=visualize)
+            if tile:  # sliced inference on the original images, includes NMS and boxes in original pixels
+                pred = [
+                    tiled_inference(model, x, tile, tile_overlap, tile_batch, conf_thres, iou_thres, classes,
+                                    agnostic_nms, max_det, tile_merge, tile_full, nms) for x in (im0s if batched else [im0s])]
+            else:
+                pred = model(im, augment=augment, visualize=visualize)
 
         # NMS
         with dt[2]:
-            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+            if not tile:
+                pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det, method=nms)
 
         # Second-stage classifier (optional)
         # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
 
-        # Process predictions
+        # Process predictions, results are written by the sink
         for i, det in enumerate(pred):  # per image
             seen += 1
-            if webcam:  # batch_size >= 1
+            if batched:  # batch_size >= 1
                 p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                s += f'{i}: '
+                s += f'{i}: ' if webcam else f'{Path(p).name}: '
             else:
                 p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
 
@@ -117,65 +204,26 @@ def run(
             save_path = str(save_dir / p.name)  # im.jpg
             txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
             s += '%gx%g ' % im.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            imc = im0.copy() if save_crop else im0  # for save_crop
-            annotator = Annotator(im0, line_width=line_thickness, example=str(names))
             if len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
+                det[:, :4] = det[:, :4].round() if tile else scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, 5].unique():
                     n = (det[:, 5] == c).sum()  # detections per class
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(f'{txt_path}.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-                    if save_img or save_crop or view_img:  # Add bbox to image
-                        c = int(cls)  # integer class
-                        label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
-                        annotator.box_label(xyxy, label, color=colors(c, True))
-                    if save_crop:
-                        save_one_box(xyxy, imc, file=save_dir / 'crops' / names[c] / f'{p.stem}.jpg', BGR=True)
-
-            # Stream results
-            im0 = annotator.result()
-            if view_img:
-                if platform.system() == 'Linux' and p not in windows:
-                    windows.append(p)
-                    cv2.namedWindow(str(p), cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)  # allow window resize (Linux)
-                    cv2.resizeWindow(str(p), im0.shape[1], im0.shape[0])
-                cv2.imshow(str(p), im0)
-                cv2.waitKey(1)  # 1 millisecond
-
-            # Save results (image with detections)
-            if save_img:
-                if dataset.mode == 'image':
-                    cv2.imwrite(save_path, im0)
-                else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
-                        if vid_cap:  # video
-                            fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                            w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                            h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        else:  # stream
-                            fps, w, h = 30, im0.shape[1], im0.shape[0]
-                        save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+            # Mode and video properties are read now, the loader may have moved on to the next file when the sink writes
+            mode = dataset.mode
+            vid_info = (vid_cap.get(cv2.CAP_PROP_FPS), int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                        int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))) if vid_cap and mode != 'image' else None
+            sink.put(p, im0, det, i, save_path, txt_path, mode, vid_info)
 
         # Print time (inference-only)
         LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt[1].dt * 1E3:.1f}ms")
 
+    sink.close()  # wait for the pending writes
+
     # Print results
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
     LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
@@ -203,6 +251,7 @@ def parse_opt():
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --classes 0, or --classes 0 2 3')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
+    parser.add_argument('--nms', type=str, default='nms', choices=NMS_METHODS, help='suppression method')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
     parser.add_argument('--visualize', action='store_true', help='visualize features')
     parser.add_argument('--update', action='store_true', help='update all models')
@@ -214,7 +263,18 @@ def parse_opt():
     parser.add_argument('--hide-conf', default=False, action='store_true', help='hide confidences')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--optimize', type=str, choices=OPTIMIZE_MODES, help='optimized PyTorch inference mode')
+    parser.add_argument('--optimize-cache', type=str, help='directory keeping optimized models for later runs')
+    parser.add_argument('--ort-threads', nargs=2, type=int, default=[0, 0], help='ONNX Runtime intra, inter-op threads')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--batch-size', type=int, default=1, help='images per forward pass for image files')
+    parser.add_argument('--workers', type=int, default=4, help='image decoding threads, 0 to decode on demand')
+    parser.add_argument('--reduced-decode', action='store_true', help='decode large JPEGs at reduced resolution')
+    parser.add_argument('--tile', type=int, default=0, help='tiled inference tile size (pixels), 0 to disable')
+    parser.add_argument('--tile-overlap', type=float, default=0.2, help='overlap between tiles (fraction of tile size)')
+    parser.add_argument('--tile-batch', type=int, default=8, help='tiles per forward pass')
+    parser.add_argument('--tile-merge', type=str, default='nms', choices=['nms', 'wbf'], help='merge tile detections')
+    parser.add_argument('--tile-full', type=int, default=0, help='extra full-image pass size in tiled mode, 0 to disable')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -27,6 +27,7 @@ from utils.dataloaders import exif_transpose, letterbox
 from utils.general import (LOGGER, ROOT, Profile, check_requirements, check_suffix, check_version, colorstr,
                            increment_path, is_notebook, make_divisible, non_max_suppression, scale_boxes,
                            xywh2xyxy, xyxy2xywh, yaml_load)
+from utils.optimize import OptimizedModel
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import copy_attr, smart_inference_mode
 
@@ -675,7 +676,16 @@ class CBFuse(nn.Module):
 
 class DetectMultiBackend(nn.Module):
     # YOLO MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolo.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, fuse=True):
+    def __init__(self,
+                 weights='yolo.pt',
+                 device=torch.device('cpu'),
+                 dnn=False,
+                 data=None,
+                 fp16=False,
+                 fuse=True,
+                 optimize=None,
+                 cache_dir=None,
+                 ort_threads=(0, 0)):
         # Usage:
         #   PyTorch:              weights = *.pt
         #   TorchScript:                    *.torchscript
@@ -689,6 +699,8 @@ class DetectMultiBackend(nn.Module):
         #   TensorFlow Lite:                *.tflite
         #   TensorFlow Edge TPU:            *_edgetpu.tflite
         #   PaddlePaddle:                   *_paddle_model
+        # PyTorch models run eager unless optimize is one of utils.optimize.OPTIMIZE_MODES (builds cached in cache_dir)
+        # ONNX Runtime runs with ort_threads (intra-op, inter-op) and its optimized graph kept in cache_dir (utils/ort.py)
         from models.experimental import attempt_download, attempt_load  # scoped to avoid circular import
 
         super().__init__()
@@ -697,6 +709,8 @@ class DetectMultiBackend(nn.Module):
         fp16 &= pt or jit or onnx or engine  # FP16
         nhwc = coreml or saved_model or pb or tflite or edgetpu  # BHWC formats (vs torch BCWH)
         stride = 32  # default stride
+        optimized = None  # OptimizedModel of a PyTorch model
+        iobinding = None  # IOBoundSession of an ONNX Runtime model on CPU
         cuda = torch.cuda.is_available() and device.type != 'cpu'  # use CUDA
         if not (pt or triton):
             w = attempt_download(w)  # download if not local
@@ -707,6 +721,9 @@ class DetectMultiBackend(nn.Module):
             names = model.module.names if hasattr(model, 'module') else model.names  # get class names
             model.half() if fp16 else model.float()
             self.model = model  # explicitly assign for to(), cpu(), cuda(), half()
+            if optimize:  # channels_last, TorchScript freeze or torch.compile
+                single = not isinstance(weights, list) or len(weights) == 1  # ensembles are not cached
+                optimized = OptimizedModel(model, optimize, cache_dir=cache_dir, weights=w if single else None)
         elif jit:  # TorchScript
             LOGGER.info(f'Loading {w} for TorchScript inference...')
             extra_files = {'config.txt': ''}  # model metadata
@@ -724,9 +741,11 @@ class DetectMultiBackend(nn.Module):
         elif onnx:  # ONNX Runtime
             LOGGER.info(f'Loading {w} for ONNX Runtime inference...')
             check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
-            import onnxruntime
+            from utils.ort import IOBoundSession, ort_session
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
-            session = onnxruntime.InferenceSession(w, providers=providers)
+            session = ort_session(w, providers, cache_dir=cache_dir, threads=ort_threads)
+            if not cuda:
+                iobinding = IOBoundSession(session)
             output_names = [x.name for x in session.get_outputs()]
             meta = session.get_modelmeta().custom_metadata_map  # metadata
             if 'stride' in meta:
@@ -872,7 +891,10 @@ class DetectMultiBackend(nn.Module):
             im = im.permute(0, 2, 3, 1)  # torch BCHW to numpy BHWC shape(1,320,192,3)
 
         if self.pt:  # PyTorch
-            y = self.model(im, augment=augment, visualize=visualize) if augment or visualize else self.model(im)
+            if augment or visualize:
+                y = self.model(im, augment=augment, visualize=visualize)
+            else:
+                y = (self.optimized or self.model)(im)
         elif self.jit:  # TorchScript
             y = self.model(im)
         elif self.dnn:  # ONNX OpenCV DNN
@@ -880,8 +902,11 @@ class DetectMultiBackend(nn.Module):
             self.net.setInput(im)
             y = self.net.forward()
         elif self.onnx:  # ONNX Runtime
-            im = im.cpu().numpy()  # torch to numpy
-            y = self.session.run(self.output_names, {self.session.get_inputs()[0].name: im})
+            if self.iobinding:
+                y = self.iobinding(im)
+            else:
+                im = im.cpu().numpy()  # torch to numpy
+                y = self.session.run(self.output_names, {self.session.get_inputs()[0].name: im})
         elif self.xml:  # OpenVINO
             im = im.cpu().numpy()  # FP32
             y = list(self.executable_network([im]).values())
@@ -948,10 +973,10 @@ class DetectMultiBackend(nn.Module):
     def from_numpy(self, x):
         return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
 
-    def warmup(self, imgsz=(1, 3, 640, 640)):
-        # Warmup model by running inference once
+    def warmup(self, imgsz=(1, 3, 640, 640), cpu=False):
+        # Warmup model by running inference once, on CPU too with cpu=True (first-call allocations, oneDNN kernels)
         warmup_types = self.pt, self.jit, self.onnx, self.engine, self.saved_model, self.pb, self.triton
-        if any(warmup_types) and (self.device.type != 'cpu' or self.triton):
+        if any(warmup_types) and (self.device.type != 'cpu' or self.triton or cpu):
             im = torch.empty(*imgsz, dtype=torch.half if self.fp16 else torch.float, device=self.device)  # input
             for _ in range(2 if self.jit else 1):  #
                 self.forward(im)  # warmup
@@ -1,10 +1,15 @@
 import math
+import os
+import zipfile
+from datetime import datetime
+from pathlib import Path
 
 import numpy as np
 import torch
 import torch.nn as nn
 
 from utils.downloads import attempt_download
+from utils.general import LOGGER, check_version
 
 
 class Sum(nn.Module):
@@ -234,22 +239,33 @@ class End2End(nn.Module):
         return x
 
 
+def load_checkpoint(f):
+    # Load a checkpoint to CPU, memory-mapped when possible (torch>=2.1 zip format): processes loading the same
+    # file then share its pages (copy-on-write) instead of each holding a private copy of the weights
+    if check_version(torch.__version__, '2.1.0') and zipfile.is_zipfile(f):
+        return torch.load(f, map_location='cpu', mmap=True)
+    return torch.load(f, map_location='cpu')
+
+
 def attempt_load(weights, device=None, inplace=True, fuse=True):
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
     from models.yolo import Detect, Model
+    from utils.qat import strip_qat
 
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
-        ckpt = torch.load(attempt_download(w), map_location='cpu')  # load
-        ckpt = (ckpt.get('ema') or ckpt['model']).to(device).float()  # FP32 model
+        ckpt = load_checkpoint(attempt_download(w))  # load
+        serving = ckpt.get('serving', False)  # already fused, in its serving dtype: use the mapped tensors as they are
+        ckpt = ckpt['model'].to(device) if serving else (ckpt.get('ema') or ckpt['model']).to(device).float()  # FP32 model
 
         # Model compatibility updates
+        strip_qat(ckpt)  # quantization-aware training blocks back to Conv/RepConvN, fused as usual
         if not hasattr(ckpt, 'stride'):
             ckpt.stride = torch.tensor([32.])
         if hasattr(ckpt, 'names') and isinstance(ckpt.names, (list, tuple)):
             ckpt.names = dict(enumerate(ckpt.names))  # convert to dict
 
-        model.append(ckpt.fuse().eval() if fuse and hasattr(ckpt, 'fuse') else ckpt.eval())  # model in eval mode
+        model.append(ckpt.fuse().eval() if fuse and not serving and hasattr(ckpt, 'fuse') else ckpt.eval())  # model in eval mode
 
     # Module compatibility updates
     for m in model.modules():
@@ -273,3 +289,20 @@ def attempt_load(weights, device=None, inplace=True, fuse=True):
     model.stride = model[torch.argmax(torch.tensor([m.stride.max() for m in model])).int()].stride  # max stride
     assert all(model[0].nc == m.nc for m in model), f'Models have different class counts: {[m.nc for m in model]}'
     return model
+
+
+def save_serving_checkpoint(weights, f=None, half=False):
+    # Save weights as a serving checkpoint: the fused inference graph only (no optimizer, EMA or training state),
+    # gradients off, in the dtype it will run in (FP16 with half=True, for GPU serving), so attempt_load() maps it
+    # without any conversion or re-fusing. Returns the path, '<weights stem>.serving.pt' by default
+    model = attempt_load(weights, device='cpu', fuse=True)
+    model.half() if half else model.float()
+    for p in model.parameters():
+        p.detach_()  # fused weights may still carry the autograd history of the fusion
+        p.requires_grad = False
+    f = Path(f or Path(weights).with_suffix('.serving.pt'))
+    tmp = f.with_name(f'.{f.name}.{os.getpid()}.tmp')
+    torch.save({'model': model, 'serving': True, 'half': half, 'source': str(weights), 'date': datetime.now().isoformat()}, tmp)
+    os.replace(tmp, f)  # atomic, concurrent writers and readers never see a partial file
+    LOGGER.info(f'Serving checkpoint saved as {f} ({os.path.getsize(f) / 1E6:.1f}MB)')
+    return f
@@ -0,0 +1,229 @@
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLO root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+# ROOT = ROOT.relative_to(Path.cwd())  # relative
+
+import export
+from models.experimental import load_checkpoint
+from utils.dataloaders import create_dataloader
+from utils.general import LOGGER, check_dataset, check_img_size, check_requirements, check_yaml, colorstr, file_size, \
+    print_args
+from utils.qat import qat_ranges, quantization_params
+from val import run as val_det
+
+CALIBRATION_METHODS = 'minmax', 'entropy', 'percentile'
+
+
+def layer_nodes(model_onnx, layers=None):
+    # Names of the nodes exported from model layers (indices, default the last one: the Detect/DDetect head and its DFL)
+    index = {n.name: int(m[1]) for n in model_onnx.graph.node if (m := re.match(r'/model\.(\d+)/', n.name))}
+    layers = set(layers) if layers is not None else {max(index.values())}
+    return [name for name, i in index.items() if i in layers]
+
+
+def onnx_scope(name):
+    # ONNX node scope of a module name, model.4.cv2.0.m.0.cv1 -> /model.4/cv2/cv2.0/m/m.0/cv1
+    atoms, scope = name.split('.'), []
+    for i, a in enumerate(atoms):
+        if not a.isdigit():
+            scope.append(a)
+        elif i == 1:  # layers are called by the model, not through its Sequential
+            scope[-1] = f'{atoms[0]}.{a}'
+        else:
+            scope.append(f'{atoms[i - 1]}.{a}')
+    return '/' + '/'.join(scope)
+
+
+def qat_overrides(model_onnx, ranges):
+    # ONNX Runtime TensorQuantOverrides setting Conv inputs to the ranges learned by quantization-aware training,
+    # a tensor read by several convolutions gets the union of their ranges. Returns overrides, unmatched module names
+    inputs = {n.name: n.input[0] for n in model_onnx.graph.node if n.op_type == 'Conv'}
+    merged, unmatched = {}, []
+    for k, (lo, hi) in ranges.items():
+        x = inputs.get(f'{onnx_scope(k)}/conv/Conv')
+        if x is None:
+            unmatched.append(k)
+            continue
+        a, b = merged.get(x, (lo, hi))
+        merged[x] = min(a, lo), max(b, hi)
+    overrides = {}
+    for x, r in merged.items():
+        scale, zero_point = quantization_params(*torch.tensor(r))
+        overrides[x] = [{
+            'scale': np.array(scale.item(), np.float32),
+            'zero_point': np.array(zero_point.item(), np.uint8)}]
+    return overrides, unmatched
+
+
+def calibration_reader(path, imgsz, batch_size, stride, images, input_name, workers=8):
+    # ONNX Runtime CalibrationDataReader over `images` letterboxed images of path, sampled across it like training
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.dataloader = create_dataloader(path,
+                                                imgsz,
+                                                batch_size,
+                                                stride,
+                                                workers=workers,
+                                                shuffle=True,
+                                                prefix=colorstr('calibration: '))[0]
+            self.batches = iter(self.dataloader)
+            self.seen = 0
+
+        def get_next(self):
+            if self.seen >= images:
+                return None
+            im = next(self.batches, (None,))[0]
+            if im is None:
+                return None
+            im = im[:images - self.seen]
+            self.seen += len(im)
+            return {input_name: (im.float() / 255).numpy()}  # uint8 to float32 0.0 - 1.0
+
+    return Reader()
+
+
+def run(
+        data=ROOT / 'data/coco.yaml',  # dataset.yaml path
+        weights=ROOT / 'yolo.pt',  # FP32 model: PyTorch .pt (exported to ONNX first) or ONNX .onnx
+        imgsz=640,  # calibration and validation size (pixels)
+        batch_size=8,  # calibration batch size
+        split='train',  # dataset split calibrated on, val is kept for the accuracy check
+        images=256,  # calibration images
+        method='minmax',  # activation range calibration: minmax, entropy or percentile
+        fp32_layers=None,  # model layer indices kept in FP32, default the head (DDetect and its DFL)
+        per_channel=True,  # per output channel weight scales
+        reduce_range=False,  # 7-bit weights, for CPUs without VNNI where 8-bit products can saturate
+        workers=8,  # max dataloader workers
+        validate=True,  # compare FP32 and INT8 mAP and speed on the val split
+        max_drop=0.01,  # accuracy gate: largest accepted mAP50-95 drop from FP32
+        hard_fail=False,  # throw error when the gate fails
+        qat=True,  # use the Conv input ranges learned by quantization-aware training (train.py --qat checkpoints)
+):
+    # Static INT8 quantization for ONNX Runtime on CPU: activation ranges are calibrated on dataset images, weights are
+    # quantized per channel. The result is a QDQ .onnx model loaded by DetectMultiBackend
+    # Checkpoints of quantization-aware training keep the Conv input scales and zero points they were trained with,
+    # only the other quantized tensors (convolution outputs, concatenations) are calibrated
+    check_requirements(('onnx', 'onnxruntime'))
+    import onnx
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    t = time.time()
+    data = check_dataset(data)
+    weights = Path(weights)
+    ranges = {}
+    if weights.suffix == '.pt' and qat:
+        ckpt = load_checkpoint(str(weights))
+        ranges = qat_ranges(ckpt.get('ema') or ckpt['model'])
+        del ckpt
+    if weights.suffix == '.pt':  # dynamic batch and size like the service exports, opset 13 for per-channel QDQ
+        weights = Path(export.run(weights=weights, imgsz=(imgsz, imgsz), include=('onnx',), dynamic=True, opset=13)[0])
+    f = weights.with_name(f'{weights.stem}-int8.onnx')
+    prefix = colorstr('INT8:')
+    LOGGER.info(f'\n{prefix} starting {method} calibration of {weights} on {images} {split} images...')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pre = os.path.join(tmp, weights.name)
+        # Symbolic shape inference does not complete on YOLO graphs, ONNX shape inference is enough for QDQ
+        quant_pre_process(str(weights), pre, skip_symbolic_shape=True)
+        model_onnx = onnx.load(pre)
+        meta = {x.key: x.value for x in model_onnx.metadata_props}
+        stride = int(meta.get('stride', 32))
+        input_name = model_onnx.graph.input[0].name
+        exclude = layer_nodes(model_onnx, fp32_layers)
+        overrides, unmatched = qat_overrides(model_onnx, ranges)
+        del model_onnx
+        if ranges:
+            LOGGER.info(f'{prefix} {len(overrides)} Conv input ranges learned by quantization-aware training')
+        if unmatched:
+            LOGGER.warning(f'WARNING ⚠️ {prefix} no Conv node for QAT blocks {", ".join(unmatched)}, calibrated')
+        reader = calibration_reader(data[split],
+                                    check_img_size(imgsz, s=stride),
+                                    batch_size,
+                                    stride,
+                                    images,
+                                    input_name,
+                                    workers=workers)
+        quantize_static(pre,
+                        f,
+                        reader,
+                        quant_format=QuantFormat.QDQ,
+                        per_channel=per_channel,
+                        reduce_range=reduce_range,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8,
+                        nodes_to_exclude=exclude,
+                        extra_options={'TensorQuantOverrides': overrides},
+                        calibrate_method={
+                            'minmax': CalibrationMethod.MinMax,
+                            'entropy': CalibrationMethod.Entropy,
+                            'percentile': CalibrationMethod.Percentile}[method])
+    LOGGER.info(f'{prefix} quantization success ✅ {time.time() - t:.1f}s, {len(exclude)} head nodes kept in FP32, '
+                f'saved as {f} ({file_size(f):.1f} MB)')
+    if not validate:
+        return f, None
+
+    # Accuracy and speed against FP32, both on ONNX Runtime with square batch 1 inference (val.py exported models)
+    y = []
+    for name, w in ('FP32', weights), ('INT8', f):
+        metrics, _, speeds = val_det(data, weights=w, imgsz=imgsz, batch_size=1, task='val', device='cpu', half=False,
+                                     workers=workers, plots=False, name=f'quantize-{name.lower()}')
+        y.append([name, round(file_size(w), 1), round(metrics[3], 4), round(speeds[1], 2)])
+    py = pd.DataFrame(y, columns=['Format', 'Size (MB)', 'mAP50-95', 'Inference time (ms)'])
+    drop = py['mAP50-95'][0] - py['mAP50-95'][1]
+    speedup = py['Inference time (ms)'][0] / py['Inference time (ms)'][1]
+    LOGGER.info(f'\n{prefix} mAP50-95 drop {drop:.4f}, inference speedup {speedup:.2f}x ({time.time() - t:.2f}s)')
+    LOGGER.info(str(py))
+    if drop > max_drop:
+        msg = f'{prefix} mAP50-95 drop {drop:.4f} exceeds {max_drop}, keep more layers in FP32 with --fp32-layers'
+        if hard_fail:
+            assert False, msg
+        LOGGER.warning(f'WARNING ⚠️ {msg}')
+    return f, py
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default=ROOT / 'data/coco.yaml', help='dataset.yaml path')
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolo.pt', help='FP32 model.pt or model.onnx path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=8, help='calibration batch size')
+    parser.add_argument('--split', type=str, default='train', help='dataset split to calibrate on')
+    parser.add_argument('--images', type=int, default=256, help='calibration images')
+    parser.add_argument('--method', type=str, default='minmax', choices=CALIBRATION_METHODS, help='calibration method')
+    parser.add_argument('--fp32-layers', nargs='+', type=int, help='layer indices kept in FP32, default the head')
+    parser.add_argument('--no-per-channel', dest='per_channel', action='store_false', help='per-tensor weight scales')
+    parser.add_argument('--reduce-range', action='store_true', help='7-bit weights, for CPUs without VNNI')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers')
+    parser.add_argument('--no-val', dest='validate', action='store_false', help='skip the FP32/INT8 comparison')
+    parser.add_argument('--max-drop', type=float, default=0.01, help='largest accepted mAP50-95 drop from FP32')
+    parser.add_argument('--hard-fail', action='store_true', help='Exception when the mAP drop exceeds --max-drop')
+    parser.add_argument('--no-qat', dest='qat', action='store_false', help='calibrate QAT checkpoints like FP32 ones')
+    opt = parser.parse_args()
+    opt.data = check_yaml(opt.data)  # check YAML
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)
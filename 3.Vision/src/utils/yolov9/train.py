@@ -22,6 +22,7 @@ if str(ROOT) not in sys.path:
     sys.path.append(str(ROOT))  # add ROOT to PATH
 ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
+import quantize  # for INT8 export after quantization-aware training
 import val as validate  # for end-of-epoch mAP
 from models.experimental import attempt_load
 from models.yolo import Model
@@ -39,6 +40,7 @@ from utils.loggers.comet.comet_utils import check_comet_resume
 from utils.loss_tal import ComputeLoss
 from utils.metrics import fitness
 from utils.plots import plot_evolve
+from utils.qat import is_qat, prepare_qat
 from utils.torch_utils import (EarlyStopping, ModelEMA, de_parallel, select_device, smart_DDP,
                                smart_optimizer, smart_resume, torch_distributed_zero_first)
 
@@ -107,6 +109,8 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
             weights = attempt_download(weights)  # download if not found locally
         ckpt = torch.load(weights, map_location='cpu')  # load checkpoint to CPU to avoid CUDA memory leak
         model = Model(cfg or ckpt['model'].yaml, ch=3, nc=nc, anchors=hyp.get('anchors')).to(device)  # create
+        if is_qat(ckpt['model']):  # resumed after --qat epoch, load activation ranges too
+            prepare_qat(model)
         exclude = ['anchor'] if (cfg or hyp.get('anchors')) and not resume else []  # exclude keys
         csd = ckpt['model'].float().state_dict()  # checkpoint state_dict as FP32
         csd = intersect_dicts(csd, model.state_dict(), exclude=exclude)  # intersect
@@ -261,6 +265,11 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
         if epoch == (epochs - opt.close_mosaic):
             LOGGER.info("Closing dataloader mosaic")
             dataset.mosaic = False
+        if epoch == opt.qat:  # BN-folded fake quantization from here on, fine-tuning weights for INT8
+            n = prepare_qat(de_parallel(model))
+            if ema:
+                prepare_qat(ema.ema)
+            LOGGER.info(f'Quantization-aware training: {n} Conv/RepConvN blocks fake-quantized')
 
         # Update mosaic border (optional)
         # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
@@ -421,6 +430,9 @@ def train(hyp, opt, device, callbacks):  # hyp is path/to/hyp.yaml or hyp dictio
                     if is_coco:
                         callbacks.run('on_fit_epoch_end', list(mloss) + list(results) + lr, epoch, best_fitness, fi)
 
+        if opt.qat >= 0:  # INT8 ONNX Runtime model with the learned Conv input ranges, mAP checked against FP32
+            quantize.run(data, best_striped if best_striped.exists() else last_striped, imgsz=imgsz, workers=workers)
+
         callbacks.run('on_train_end', last, best, epoch, results)
 
     torch.cuda.empty_cache()
@@ -469,6 +481,7 @@ def parse_opt(known=False):
     parser.add_argument('--local_rank', type=int, default=-1, help='Automatic DDP Multi-GPU argument, do not modify')
     parser.add_argument('--min-items', type=int, default=0, help='Experimental')
     parser.add_argument('--close-mosaic', type=int, default=0, help='Experimental')
+    parser.add_argument('--qat', type=int, default=-1, help='quantization-aware training from this epoch, -1 disabled')
 
     # Logger arguments
     parser.add_argument('--entity', default=None, help='Entity')
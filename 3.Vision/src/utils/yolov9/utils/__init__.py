@@ -1,5 +1,6 @@
 import contextlib
 import platform
+import queue
 import threading
 
 
@@ -32,6 +33,45 @@ def threaded(func):
     return wrapper
 
 
+class BackgroundSink:
+    # Calls fn(*args) for each put() on a background thread, in order. At most maxsize calls wait in the queue, put()
+    # blocks beyond that (backpressure). close() drains the queue and re-raises the first error; threaded=False calls
+    # fn directly, i.e. for OpenCV windows that must stay on the main thread
+    def __init__(self, fn, maxsize=8, threaded=True):
+        self.fn = fn
+        self.error = None
+        self.queue = queue.Queue(maxsize) if threaded else None
+        if threaded:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def put(self, *args):
+        if self.error is not None:
+            raise self.error
+        if self.queue is None:
+            self.fn(*args)
+        else:
+            self.queue.put(args)
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            args = self.queue.get()
+            if args is None:
+                break
+            if self.error is None:  # keep draining after an error so put() never blocks forever
+                try:
+                    self.fn(*args)
+                except Exception as e:
+                    self.error = e
+
+
 def join_threads(verbose=False):
     # Join all daemon threads, i.e. atexit.register(lambda: join_threads())
     main_thread = threading.current_thread()
@@ -103,8 +103,17 @@ def replicate(im, labels):
     return im, labels
 
 
-def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
+def letterbox(im,
+              new_shape=(640, 640),
+              color=(114, 114, 114),
+              auto=True,
+              scaleFill=False,
+              scaleup=True,
+              stride=32,
+              dst=None):
     # Resize and pad image while meeting stride-multiple constraints
+    # With dst, a preallocated uint8 HWC array at least as large as the result (i.e. a LetterboxBuffer row), the image
+    # is resized straight into it and only the border is filled; the returned image is then a view of dst
     shape = im.shape[:2]  # current shape [height, width]
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
@@ -128,14 +137,62 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
     dw /= 2  # divide padding into 2 sides
     dh /= 2
 
-    if shape[::-1] != new_unpad:  # resize
-        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    if dst is not None:  # resize into dst, no intermediate copies
+        (w, h), H, W = new_unpad, new_unpad[1] + top + bottom, new_unpad[0] + left + right
+        assert H <= dst.shape[0] and W <= dst.shape[1], f'letterbox shape {(H, W)} exceeds dst shape {dst.shape[:2]}'
+        out = dst[:H, :W]
+        if shape[::-1] != new_unpad:  # resize
+            cv2.resize(im, new_unpad, dst=out[top:top + h, left:left + w], interpolation=cv2.INTER_LINEAR)
+        else:
+            out[top:top + h, left:left + w] = im
+        out[:top], out[top + h:] = color, color  # add border
+        out[top:top + h, :left], out[top:top + h, left + w:] = color, color
+        return out, ratio, (dw, dh)
+
+    if shape[::-1] != new_unpad:  # resize
+        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return im, ratio, (dw, dh)
 
 
+class LetterboxBuffer:
+    # Preallocated uint8 (n, h, w, 3) BGR batch buffer that images are letterboxed straight into, one per row, instead
+    # of resize -> copyMakeBorder -> np.stack copies. Rows are reused: a view is valid until its row is written again
+    def __init__(self, n=1, shape=(640, 640)):
+        self.buffer = np.empty((n, *np.broadcast_to(shape, 2), 3), dtype=np.uint8)
+
+    def reserve(self, n, shape):
+        # Grow to at least n rows of shape (h, w), views of the previous buffer stay valid
+        b, (h, w) = self.buffer.shape, np.broadcast_to(shape, 2)
+        if n > b[0] or h > b[1] or w > b[2]:
+            self.buffer = np.empty((max(n, b[0]), max(h, b[1]), max(w, b[2]), 3), dtype=np.uint8)
+        return self
+
+    def letterbox(self, i, im, new_shape=(640, 640), **kwargs):
+        # letterbox() image im into row i, returns (view of row i, ratio, (dw, dh))
+        return letterbox(im, new_shape, dst=self.buffer[i], **kwargs)
+
+    def rows(self, i, n, shape):
+        # (n, h, w, 3) view of rows i to i + n letterboxed to shape (h, w)
+        return self.buffer[i:i + n, :shape[0], :shape[1]]
+
+
+def to_tensor(im, device='cpu', half=False, bgr_hwc=False):
+    # uint8 image(s) to the model input tensor, 0 - 255 to 0.0 - 1.0 fp16/32, in a single pass over the pixels
+    # im is RGB CHW (3, h, w) or (n, 3, h, w), with bgr_hwc BGR HWC (h, w, 3) or (n, h, w, 3) (i.e. LetterboxBuffer
+    # rows) whose BGR to RGB and HWC to CHW swaps are fused into that pass instead of np.ascontiguousarray() copies
+    if bgr_hwc:
+        im = im.transpose((2, 0, 1))[::-1] if im.ndim == 3 else im.transpose((0, 3, 1, 2))[:, ::-1]  # views
+    if torch.device(device).type != 'cpu':  # copy uint8 (4x less than float) to the device and normalize there
+        im = torch.from_numpy(np.ascontiguousarray(im)).to(device)
+        return (im.half() if half else im.float()) / 255
+    x = torch.empty(im.shape, dtype=torch.float16 if half else torch.float32)
+    np.divide(im, np.float16(255) if half else np.float32(255), out=x.numpy())
+    return x
+
+
 def random_perspective(im,
                        targets=(),
                        segments=(),
@@ -23,8 +23,8 @@ from PIL import ExifTags, Image, ImageOps
 from torch.utils.data import DataLoader, Dataset, dataloader, distributed
 from tqdm import tqdm
 
-from utils.augmentations import (Albumentations, augment_hsv, classify_albumentations, classify_transforms, copy_paste,
-                                 letterbox, mixup, random_perspective)
+from utils.augmentations import (Albumentations, LetterboxBuffer, augment_hsv, classify_albumentations,
+                                 classify_transforms, copy_paste, letterbox, mixup, random_perspective)
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset, check_requirements,
                            check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy,
                            xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
@@ -88,6 +88,39 @@ def exif_transpose(image):
     return image
 
 
+def imread_reduced(f, size, shape=None):
+    # Reads a BGR image at reduced resolution, still at least 'size' on its long side. JPEGs are decoded at the largest
+    # DCT scale-down factor (1/8, 1/4, 1/2) that allows it, which skips most of the decode work for high-res images.
+    # Returns (im, original hw); 'shape' is the original exif-corrected hw if already known, else read from the header
+    with contextlib.suppress(Exception):
+        with Image.open(f) as img:
+            if img.format == 'JPEG':
+                h0, w0 = shape if shape is not None else exif_size(img)[::-1]
+                for factor, flag in (8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2):
+                    if max(h0, w0) >= size * factor:
+                        im = cv2.imread(f, flag)  # BGR, exif orientation applied like cv2.imread(f)
+                        if im is not None and im.shape[:2] == (math.ceil(h0 / factor), math.ceil(w0 / factor)):
+                            return im, (int(h0), int(w0))
+                        break  # orientation or size disagrees with the header, decode in full instead
+    im = cv2.imread(f)  # BGR
+    return im, im.shape[:2] if im is not None else None
+
+
+def rect_batch_shapes(ar, bi, img_size=640, stride=32, pad=0.0):
+    # Letterbox shape (h, w) of each batch of images sorted by aspect ratio ar (h/w), bi is the batch index of each
+    # image. Every batch gets the smallest stride-multiple rectangle that fits all of its images at img_size
+    nb = bi[-1] + 1  # number of batches
+    shapes = [[1, 1]] * nb
+    for i in range(nb):
+        ari = ar[bi == i]
+        mini, maxi = ari.min(), ari.max()
+        if maxi < 1:
+            shapes[i] = [maxi, 1]
+        elif mini > 1:
+            shapes[i] = [1, 1 / mini]
+    return np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
+
+
 def seed_worker(worker_id):
     # Set dataloader worker seed https://pytorch.org/docs/stable/notes/randomness.html#dataloader
     worker_seed = torch.initial_seed() % 2 ** 32
@@ -236,7 +269,22 @@ class LoadScreenshots:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    # With batch_size > 1 images are returned in batches of similar aspect ratio (paths, BCHW array, im0 list), each
+    # letterboxed to its rect batch shape (auto=True) or to img_size; video frames are still returned one at a time
+    # With workers > 0 a thread pool decodes and letterboxes the next images while the current ones are processed
+    # With hwc=True images are letterboxed into a preallocated LetterboxBuffer and returned as BGR HWC views of it,
+    # (h, w, 3) or (n, h, w, 3), for to_tensor(bgr_hwc=True); a view is valid until the following iteration
+    def __init__(self,
+                 path,
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 reduced=False,
+                 batch_size=1,
+                 workers=0,
+                 hwc=False):
         files = []
         for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
             p = str(Path(p).resolve())
@@ -252,9 +300,15 @@ class LoadImages:
         images = [x for x in files if x.split('.')[-1].lower() in IMG_FORMATS]
         videos = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
         ni, nv = len(images), len(videos)
+        assert batch_size == 1 or not transforms, 'batched images do not support transforms'
+        assert not (hwc and transforms), 'hwc output does not support transforms'
 
         self.img_size = img_size
         self.stride = stride
+        self.batch_size = batch_size
+        self.ni = ni  # number of images
+        if batch_size > 1 and ni:
+            images, self.batch_shapes = self._rect_batches(images, img_size, stride, batch_size, auto)
         self.files = images + videos
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
@@ -262,6 +316,15 @@ class LoadImages:
         self.auto = auto
         self.transforms = transforms  # optional
         self.vid_stride = vid_stride  # video frame-rate stride
+        self.reduced = reduced  # decode images at reduced resolution, im0 is then smaller than the file
+        self.pool = ThreadPool(workers) if workers and ni else None
+        self.prefetch = 2 * max(workers, batch_size)  # images decoded ahead, bounds the memory held by the pool
+        self._ahead = {}  # image index -> pending _load() result
+        self.hwc = hwc
+        if hwc:  # ring of buffer rows, images in flight in the pool never overwrite the batch returned last
+            self.rows = (self.prefetch // batch_size + 2) * batch_size if self.pool else batch_size
+            shapes = self.batch_shapes if batch_size > 1 and ni else []
+            self.buffer = LetterboxBuffer(self.rows, np.max([np.broadcast_to(img_size, 2), *shapes], 0))
         if any(videos):
             self._new_video(videos[0])  # new video
         else:
@@ -271,6 +334,7 @@ class LoadImages:
 
     def __iter__(self):
         self.count = 0
+        self._ahead = {}
         return self
 
     def __next__(self):
@@ -297,15 +361,32 @@ class LoadImages:
             # im0 = self._cv2_rotate(im0)  # for use if cv2 autorotation is False
             s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.frames}) {path}: '
 
+        elif self.batch_size > 1:
+            # Read a batch of images
+            paths = self.files[self.count:min(self.count + self.batch_size, self.ni)]
+            im0s, ims = zip(*(self._get(i) for i in range(self.count, self.count + len(paths))))
+            if self.hwc:  # the images were letterboxed into consecutive buffer rows
+                im0s, im = list(im0s), self.buffer.rows(self.count % self.rows, len(paths), ims[0].shape[:2])
+            else:
+                im0s, im = list(im0s), np.stack(ims)
+                im = np.ascontiguousarray(im.transpose((0, 3, 1, 2))[:, ::-1])  # BHWC to BCHW, BGR to RGB, contiguous
+            s = f'images {self.count + 1}-{self.count + len(paths)}/{self.nf}: '
+            self.count += len(paths)
+            return paths, im, im0s, self.cap, s
+
         else:
             # Read image
+            im0, im = self._get(self.count)  # BGR
             self.count += 1
-            im0 = cv2.imread(path)  # BGR
-            assert im0 is not None, f'Image Not Found {path}'
             s = f'image {self.count}/{self.nf} {path}: '
+            if not (self.transforms or self.hwc):
+                im = np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB, contiguous
+            return path, im, im0, self.cap, s
 
         if self.transforms:
             im = self.transforms(im0)  # transforms
+        elif self.hwc:
+            im = self.buffer.letterbox(0, im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
         else:
             im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
             im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
@@ -313,6 +394,51 @@ class LoadImages:
 
         return path, im, im0, self.cap, s
 
+    def _get(self, i):
+        # (im0, letterboxed HWC image) of image index i, from the pool when prefetching
+        if self.pool is None:
+            return self._load(i)
+        for j in range(i, min(i + self.prefetch, self.ni)):  # keep the next images in flight
+            if j not in self._ahead:
+                self._ahead[j] = self.pool.apply_async(self._load, (j,))
+        return self._ahead.pop(i).get()
+
+    def _load(self, i):
+        path = self.files[i]
+        im0 = imread_reduced(path, np.max(self.img_size))[0] if self.reduced else cv2.imread(path)  # BGR
+        assert im0 is not None, f'Image Not Found {path}'
+        if self.transforms:
+            return im0, self.transforms(im0)  # transforms
+        if self.hwc:  # padded resize into a buffer row
+            if self.batch_size > 1:
+                shape, auto = self.batch_shapes[i // self.batch_size], False
+            else:
+                shape, auto = self.img_size, self.auto
+            return im0, self.buffer.letterbox(i % self.rows, im0, shape, stride=self.stride, auto=auto)[0]
+        if self.batch_size > 1:
+            return im0, letterbox(im0, self.batch_shapes[i // self.batch_size], stride=self.stride, auto=False)[0]
+        return im0, letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
+
+    @staticmethod
+    def _rect_batches(images, img_size, stride, batch_size, rect=True):
+        # Sort images by aspect ratio (read from the file headers) and compute the letterbox shape of each batch
+        s = []
+        for f in images:
+            try:
+                with Image.open(f) as im:
+                    s.append(exif_size(im))  # (width, height)
+            except Exception:  # unreadable here, left to cv2.imread() when the batch is loaded
+                s.append((1, 1))
+        ar = np.array([h / w for w, h in s])  # aspect ratio
+        irect = ar.argsort(kind='stable')
+        images, ar = [images[i] for i in irect], ar[irect]
+        bi = np.floor(np.arange(len(images)) / batch_size).astype(int)  # batch index
+        if rect:
+            shapes = rect_batch_shapes(ar, bi, np.array(img_size), stride)
+        else:  # fixed input shape
+            shapes = np.tile(np.broadcast_to(img_size, 2), (bi[-1] + 1, 1))
+        return images, shapes
+
     def _new_video(self, path):
         # Create a new video capture object
         self.frame = 0
@@ -337,7 +463,15 @@ class LoadImages:
 
 class LoadStreams:
     # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='streams.txt', img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    # With hwc=True frames are letterboxed into a preallocated LetterboxBuffer, see LoadImages
+    def __init__(self,
+                 sources='streams.txt',
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 hwc=False):
         torch.backends.cudnn.benchmark = True  # faster for fixed-size inference
         self.mode = 'stream'
         self.img_size = img_size
@@ -378,6 +512,9 @@ class LoadStreams:
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         self.auto = auto and self.rect
         self.transforms = transforms  # optional
+        assert not (hwc and transforms), 'hwc output does not support transforms'
+        self.hwc = hwc
+        self.buffer = LetterboxBuffer(n, img_size) if hwc else None  # one row per stream
         if not self.rect:
             LOGGER.warning('WARNING ⚠️ Stream shapes differ. For optimal performance supply similarly-shaped streams.')
 
@@ -410,6 +547,10 @@ class LoadStreams:
         im0 = self.imgs.copy()
         if self.transforms:
             im = np.stack([self.transforms(x) for x in im0])  # transforms
+        elif self.hwc:
+            for i, x in enumerate(im0):
+                im = self.buffer.letterbox(i, x, self.img_size, stride=self.stride, auto=self.auto)[0]  # resize
+            im = self.buffer.rows(0, len(im0), im.shape[:2])
         else:
             im = np.stack([letterbox(x, self.img_size, stride=self.stride, auto=self.auto)[0] for x in im0])  # resize
             im = im[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
@@ -520,7 +661,6 @@ class LoadImagesAndLabels(Dataset):
         # Create indices
         n = len(self.shapes)  # number of images
         bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
-        nb = bi[-1] + 1  # number of batches
         self.batch = bi  # batch index of image
         self.n = n
         self.indices = range(n)
@@ -551,16 +691,7 @@ class LoadImagesAndLabels(Dataset):
             ar = ar[irect]
 
             # Set training image shapes
-            shapes = [[1, 1]] * nb
-            for i in range(nb):
-                ari = ar[bi == i]
-                mini, maxi = ari.min(), ari.max()
-                if maxi < 1:
-                    shapes[i] = [maxi, 1]
-                elif mini > 1:
-                    shapes[i] = [1, 1 / mini]
-
-            self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
+            self.batch_shapes = rect_batch_shapes(ar, bi, img_size, stride, pad)
 
         # Cache images into RAM/disk for faster training
         if cache_images == 'ram' and not self.check_cache_ram(prefix=prefix):
@@ -726,12 +857,13 @@ class LoadImagesAndLabels(Dataset):
         if im is None:  # not cached in RAM
             if fn.exists():  # load npy
                 im = np.load(fn)
-            else:  # read image
-                im = cv2.imread(f)  # BGR
+                h0, w0 = im.shape[:2]  # orig hw
+            else:  # read image, at reduced resolution when much larger than img_size
+                im, hw0 = imread_reduced(f, self.img_size, self.shapes[i][::-1])  # BGR, orig hw
                 assert im is not None, f'Image Not Found {f}'
-            h0, w0 = im.shape[:2]  # orig hw
+                h0, w0 = hw0
             r = self.img_size / max(h0, w0)  # ratio
-            if r != 1:  # if sizes are not equal
+            if r != 1 or im.shape[:2] != (h0, w0):  # if sizes are not equal
                 interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
                 im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=interp)
             return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
@@ -33,7 +33,8 @@ import yaml
 
 from utils import TryExcept, emojis
 from utils.downloads import gsutil_getsize
-from utils.metrics import box_iou, fitness
+from utils.metrics import fitness
+from utils.nms import suppress
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[1]  # YOLO root directory
@@ -892,15 +893,23 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        method='nms',  # suppression, one of utils.nms.NMS_METHODS
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
+    The whole batch is processed at once: confidence filtering, class filtering and per-image top-k run on the batch
+    tensor, and on GPU a single NMS call separates images and classes by coordinate offsets. Every image keeps all of
+    its detections, there is no time limit. Other methods than greedy 'nms' (see utils/nms.py) run per image in
+    fixed-size blocks, their cost stays bounded for crowded images with many candidates.
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
 
     if isinstance(prediction, (list, tuple)):  # YOLO model in validation model, output = (inference_out, loss_out)
         prediction = prediction[0]  # select only inference output
+    if isinstance(prediction, (list, tuple)):  # unconverted dual/triple head model, main branch is last
+        prediction = prediction[-1]
 
     device = prediction.device
     mps = 'mps' in device.type  # Apple MPS
@@ -908,8 +917,6 @@ def non_max_suppression(
         prediction = prediction.cpu()
     bs = prediction.shape[0]  # batch size
     nc = prediction.shape[1] - nm - 4  # number of classes
-    mi = 4 + nc  # mask start index
-    xc = prediction[:, 4:mi].amax(1) > conf_thres  # candidates
 
     # Checks
     assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
@@ -918,80 +925,70 @@ def non_max_suppression(
     # Settings
     # min_wh = 2  # (pixels) minimum box width and height
     max_wh = 7680  # (pixels) maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
-    time_limit = 2.5 + 0.05 * bs  # seconds to quit after
-    redundant = True  # require redundant detections
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
-
-    t = time.time()
-    output = [torch.zeros((0, 6 + nm), device=prediction.device)] * bs
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        # x[((x[:, 2:4] < min_wh) | (x[:, 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x.T[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            lb = labels[xi]
-            v = torch.zeros((len(lb), nc + nm + 5), device=x.device)
-            v[:, :4] = lb[:, 1:5]  # box
-            v[range(len(lb)), lb[:, 0].long() + 4] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        box, cls, mask = x.split((4, nc, nm), 1)
-        box = xywh2xyxy(box)  # center_x, center_y, width, height) to (x1, y1, x2, y2)
-        if multi_label:
-            i, j = (cls > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, 4 + j, None], j[:, None].float(), mask[i]), 1)
-        else:  # best class only
-            conf, j = cls.max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float(), mask), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-        else:
-            x = x[x[:, 4].argsort(descending=True)]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        if mps:
-            output[xi] = output[xi].to(device)
-        if (time.time() - t) > time_limit:
-            LOGGER.warning(f'WARNING ⚠️ NMS time limit {time_limit:.3f}s exceeded')
-            break  # time limit exceeded
-
-    return output
+
+    # Detections matrix nx6 (xyxy, conf, cls) of the whole batch, with the image index of each row in bi
+    box, cls, mask = prediction.transpose(1, 2).split((4, nc, nm), 2)
+    if multi_label:
+        bi, k, j = (cls > conf_thres).nonzero(as_tuple=True)
+        conf = cls[bi, k, j]
+    else:  # best class only
+        conf, j = cls.max(2)
+        bi, k = (conf > conf_thres).nonzero(as_tuple=True)
+        conf, j = conf[bi, k], j[bi, k]
+    x = torch.cat((xywh2xyxy(box[bi, k]), conf[:, None], j[:, None].float(), mask[bi, k]), 1)
+
+    # Cat apriori labels if autolabelling
+    for xi, lb in enumerate(labels):
+        if len(lb) and conf_thres < 1:
+            v = torch.zeros((len(lb), 6 + nm), device=x.device)
+            v[:, :4] = xywh2xyxy(lb[:, 1:5])  # box
+            v[:, 4], v[:, 5] = 1.0, lb[:, 0]  # conf, cls
+            x, bi = torch.cat((x, v), 0), torch.cat((bi, torch.full((len(lb),), xi, device=bi.device)))
+
+    # Filter by class
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, bi = x[keep], bi[keep]
+
+    # Apply finite constraint
+    # if not torch.isfinite(x).all():
+    #     x = x[torch.isfinite(x).all(1)]
+
+    # Sort by image then confidence, keep the max_nms most confident boxes of each image
+    i = x[:, 4].argsort(descending=True)
+    i = i[torch.sort(bi[i], stable=True)[1]]
+    i = i[_rank_in_image(bi[i], bs) < max_nms]
+    x, bi = x[i], bi[i]
+
+    # Batched NMS, boxes offset by class within an image as for a single image
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    if method != 'nms':
+        n = torch.bincount(bi, minlength=bs)
+        i = torch.cat([suppress(x[j:j + k], boxes[j:j + k], method, conf_thres, iou_thres, max_det) + j
+                       for j, k in zip((n.cumsum(0) - n).tolist(), n.tolist())])
+    elif x.device.type == 'cpu':
+        # One NMS per image slice of the sorted batch: a single CPU call compares every kept box with the candidates
+        # of all images, its cost grows with the square of the batch size
+        n = torch.bincount(bi, minlength=bs)
+        i = torch.cat([torchvision.ops.nms(boxes[j:j + k], scores[j:j + k], iou_thres) + j
+                       for j, k in zip((n.cumsum(0) - n).tolist(), n.tolist())])
+    else:
+        # A single NMS call for the whole batch, images offset in float64 so that they do not cost any box precision
+        boxes = boxes.double() + bi[:, None].double() * (2 * (nc + 1) * max_wh)  # boxes (offset by class, image)
+        i = torchvision.ops.nms(boxes, scores.double(), iou_thres)  # NMS, descending confidence
+    i = i[torch.sort(bi[i], stable=True)[1]]  # by image, descending confidence within each
+    i = i[_rank_in_image(bi[i], bs) < max_det]  # limit detections
+    x = x[i].to(device) if mps else x[i]
+    return list(x.split(torch.bincount(bi[i], minlength=bs).tolist()))
+
+
+def _rank_in_image(bi, bs):
+    # Position of each row within its image, for rows sorted by image index bi
+    n = torch.bincount(bi, minlength=bs)
+    return torch.arange(len(bi), device=bi.device) - (n.cumsum(0) - n)[bi]
 
 
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
@@ -0,0 +1,80 @@
+# YOLO suppression alternatives to greedy NMS, computed on IoU matrices in fixed-size blocks
+# References: Cluster-NMS (Zheng et al., TCYB 2021), Matrix NMS (SOLOv2, NeurIPS 2020)
+
+import torch
+
+from utils.metrics import box_iou
+
+NMS_METHODS = 'nms', 'cluster', 'cluster-merge', 'matrix'
+
+
+def suppress(x, boxes, method='cluster', conf_thres=0.25, iou_thres=0.45, max_det=300):
+    # Apply a NMS_METHODS alternative to the detections x (n,6+) [xyxy, conf, cls, ...] of one image, sorted by
+    # descending confidence, boxes (n,4) offset by class. x is updated in place (merged boxes or decayed confidences)
+    # Returns the kept indices, by descending confidence
+    assert method in NMS_METHODS[1:], f'Unknown NMS method {method}, valid values are {", ".join(NMS_METHODS)}'
+    if method == 'matrix':  # only the 4 * max_det most confident candidates are decayed (pre-NMS top-k)
+        n = min(len(x), 4 * max_det)
+        x[:n, 4] = matrix_nms(boxes[:n], x[:n, 4])
+        i = x[:n, 4].argsort(descending=True)
+        return i[x[i, 4] > conf_thres][:max_det]
+    i = cluster_nms(boxes, iou_thres, max_det)
+    if method == 'cluster-merge':
+        x[i, :4] = merge_boxes(boxes, x, i, iou_thres)
+    return i
+
+
+def cluster_nms(boxes, iou_thres=0.45, max_det=300, block=1024):
+    # Suppress overlapping boxes (n,4) xyxy sorted by descending confidence, return kept indices in that order
+    # Same result as greedy NMS, obtained with matrix iterations: within each block of candidates the keep mask is
+    # refined until stable (Cluster-NMS), boxes already suppressed by kept boxes of earlier blocks are dropped first.
+    # Stops once max_det boxes are kept, memory stays within block x max(block, max_det)
+    keep = []
+    for i in range(0, len(boxes), block):
+        b = boxes[i:i + block]
+        alive = torch.ones(len(b), dtype=torch.bool, device=boxes.device)
+        if keep:
+            alive = box_iou(boxes[torch.cat(keep)], b).amax(0) <= iou_thres  # not suppressed by earlier blocks
+        iou = box_iou(b, b).triu_(diagonal=1)  # IoU with each higher-confidence box of the block
+        kept = alive
+        for _ in range(len(b)):
+            suppressed = (iou * kept[:, None]).amax(0) > iou_thres  # only kept boxes suppress
+            update = alive & ~suppressed
+            if torch.equal(update, kept):
+                break
+            kept = update
+        keep.append(kept.nonzero().view(-1) + i)
+        if sum(len(k) for k in keep) >= max_det:
+            break
+    return torch.cat(keep)[:max_det] if keep else torch.zeros(0, dtype=torch.long, device=boxes.device)
+
+
+def merge_boxes(boxes, x, keep, iou_thres=0.45, block=1024):
+    # Merge-NMS: replace each kept box by the confidence-weighted mean of the candidates overlapping it by more than
+    # iou_thres, x (n,6+) [xyxy, conf, ...] holds the coordinates to merge, boxes (n,4) those to compare (class offset)
+    wsum = torch.zeros((len(keep), 1), dtype=x.dtype, device=x.device)
+    merged = torch.zeros((len(keep), 4), dtype=x.dtype, device=x.device)
+    for i in range(0, len(boxes), block):
+        weights = (box_iou(boxes[keep], boxes[i:i + block]) > iou_thres) * x[i:i + block, 4]  # box weights
+        merged += weights @ x[i:i + block, :4]
+        wsum += weights.sum(1, keepdim=True)
+    return merged / wsum  # every kept box overlaps itself, wsum > 0
+
+
+def matrix_nms(boxes, scores, kernel='gaussian', sigma=2.0, block=1024):
+    # Decay the confidence of boxes (n,4) xyxy sorted by descending confidence by their overlap with more confident
+    # boxes, compensated by how much those were decayed themselves (Matrix NMS). Returns the decayed scores (n,)
+    # All boxes are kept, callers re-threshold. Columns are processed in blocks, memory stays within n x block
+    n = len(boxes)
+    compensate = torch.zeros(n, dtype=scores.dtype, device=boxes.device)  # max IoU with a more confident box
+    decay = torch.ones(n, dtype=scores.dtype, device=boxes.device)
+    for i in range(0, n, block):
+        j = min(i + block, n)
+        iou = box_iou(boxes[:j], boxes[i:j]).triu_(diagonal=1 - i)  # rows more confident than columns only
+        compensate[i:j] = iou.amax(0)
+        if kernel == 'gaussian':
+            d = torch.exp(-sigma * (iou ** 2 - compensate[:j, None] ** 2))
+        else:  # linear
+            d = (1 - iou) / (1 - compensate[:j, None]).clamp(min=1e-7)
+        decay[i:j] = d.amin(0)
+    return scores * decay
@@ -0,0 +1,136 @@
+# YOLO optimized PyTorch inference: channels_last memory format, TorchScript freeze or torch.compile
+# Optimized models are built per input shape bucket (shape, dtype, device) and checked against eager when built
+
+import hashlib
+import os
+import time
+import warnings
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from utils.general import LOGGER, colorstr
+
+OPTIMIZE_MODES = 'channels_last', 'jit', 'compile'
+
+
+def flatten_outputs(y):
+    # Model outputs (nested lists/tuples of tensors) as a flat list of tensors
+    return [t for x in y for t in flatten_outputs(x)] if isinstance(y, (list, tuple)) else [y]
+
+
+def unflatten_outputs(template, flat):
+    # Nest flat tensors like the template outputs, inverse of flatten_outputs()
+    it = iter(flat)
+
+    def nest(t):
+        return type(t)(nest(x) for x in t) if isinstance(t, (list, tuple)) else next(it)
+
+    return nest(template)
+
+
+class FlatOutputs(nn.Module):
+    # Model returning its outputs as a flat tuple, TorchScript traces cannot output lists of lists (dual heads)
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return tuple(flatten_outputs(self.model(x)))
+
+
+def cache_key(weights, version=torch.__version__):
+    # Cache file prefix of weights: stem and hash of the source file (path, size, modification time) and runtime version
+    stat = os.stat(weights)
+    source = f'{Path(weights).resolve()}|{stat.st_size}|{stat.st_mtime_ns}|{version}'
+    return f'{Path(weights).stem}-{hashlib.sha1(source.encode()).hexdigest()[:12]}'
+
+
+class OptimizedModel:
+    # Callable running a fused eval model in one of OPTIMIZE_MODES, all of them on channels_last inputs:
+    #   channels_last  eager in NHWC memory format
+    #   jit            TorchScript traced and frozen per shape bucket, traces are saved to cache_dir
+    #   compile        torch.compile (inductor) without dynamic shapes, its kernel cache kept in cache_dir
+    # With cache_dir and weights later starts load saved traces/kernels instead of building them again.
+    # Each bucket is run on a random input against eager NCHW when built; a bucket whose outputs differ by more than
+    # rtol/atol (x10 for fp16) runs eager instead, with a warning
+    def __init__(self, model, mode='jit', cache_dir=None, weights=None, rtol=1e-3, atol=1e-3):
+        assert mode in OPTIMIZE_MODES, f'Unknown optimize mode {mode}, valid values are {", ".join(OPTIMIZE_MODES)}'
+        with torch.inference_mode(False):  # models loaded under inference_mode hold inference tensors, not traceable
+            for m in model.modules():  # normal leaf copies, fused models may also hold non-leaf parameters
+                for k, p in m._parameters.items():
+                    if p is not None:
+                        m._parameters[k] = nn.Parameter(p.detach().clone(), requires_grad=False)
+                for k, b in m._buffers.items():
+                    if b is not None:
+                        m._buffers[k] = b.clone()
+            self.model = model.to(memory_format=torch.channels_last)  # in place, eager NCHW inputs still work
+        self.mode = mode
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.key = cache_key(weights) if self.cache_dir and isinstance(weights, (str, Path)) else None
+        self.rtol, self.atol = rtol, atol
+        self.buckets = {}  # (shape, dtype, device) -> callable
+        self.compiled = None  # torch.compile module, shared by all buckets
+        if mode == 'compile' and self.cache_dir:  # kernels, and whole graphs with torch>=2.2
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(self.cache_dir / 'inductor'))
+            import torch._inductor.config as inductor_config
+            if hasattr(inductor_config, 'fx_graph_cache'):
+                inductor_config.fx_graph_cache = True
+
+    def __call__(self, im):
+        k = tuple(im.shape), im.dtype, im.device
+        fn = self.buckets.get(k)
+        if fn is None:
+            fn = self.buckets[k] = self.build(im.shape, im.dtype, im.device)
+        return fn(im.contiguous(memory_format=torch.channels_last))
+
+    def build(self, shape, dtype, device):
+        # Build and check the optimized model of one input shape bucket
+        t = time.perf_counter()
+        x = torch.rand(shape, generator=torch.Generator().manual_seed(0)).to(device, dtype)
+        xc = x.contiguous(memory_format=torch.channels_last)
+        out = self.model(x)  # eager reference, also the output structure of jit traces
+        if self.mode == 'channels_last':
+            fn = self.model
+        elif self.mode == 'jit':
+            ts = torch.jit.freeze(self._trace(xc).eval())
+            spec = unflatten_outputs(out, [None] * len(flatten_outputs(out)))  # output structure, no tensors held
+            fn = lambda im: unflatten_outputs(spec, ts(im))  # noqa: E731
+        else:
+            if self.compiled is None:
+                self.compiled = torch.compile(self.model, dynamic=False)
+            fn = self.compiled
+        y, ref = flatten_outputs(fn(xc)), flatten_outputs(out)
+        tol = 10 if dtype == torch.float16 else 1
+        if len(y) != len(ref) or any(a.shape != b.shape for a, b in zip(y, ref)):
+            err = 'different output shapes'
+        else:
+            err = f'max error {max((a.float() - b.float()).abs().max().item() for a, b in zip(y, ref)):.3g}'
+            if all(torch.allclose(a.float(), b.float(), rtol=self.rtol * tol, atol=self.atol * tol)
+                   for a, b in zip(y, ref)):
+                err = None
+        if err is not None:
+            LOGGER.warning(f'WARNING ⚠️ {self.mode} outputs differ from eager for input {tuple(shape)} '
+                           f'({err}), running eager for this shape')
+            return self.model
+        LOGGER.info(f'{colorstr(self.mode + ":")} input {tuple(shape)} ready in {time.perf_counter() - t:.1f}s')
+        return fn
+
+    def _trace(self, im):
+        # TorchScript trace of the model for input im, loaded from cache_dir when saved by an earlier run
+        f = None
+        if self.key:
+            b, c, h, w = im.shape
+            f = self.cache_dir / f'{self.key}_{b}x{c}x{h}x{w}_{str(im.dtype)[6:]}_{im.device.type}.torchscript'
+        if f and f.exists():
+            return torch.jit.load(f, map_location=im.device)
+        with warnings.catch_warnings():
+            warnings.filterwarnings(action='ignore', category=torch.jit.TracerWarning)  # suppress TracerWarning
+            ts = torch.jit.trace(FlatOutputs(self.model), im, check_trace=False)
+        if f:  # write then rename, concurrent starts never load a partial file
+            f.parent.mkdir(parents=True, exist_ok=True)
+            tmp = f.with_suffix(f'.{os.getpid()}.tmp')
+            torch.jit.save(ts, tmp)
+            os.replace(tmp, f)
+        return ts
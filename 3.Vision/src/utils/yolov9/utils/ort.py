@@ -0,0 +1,88 @@
+# YOLO ONNX Runtime inference: optimized graphs kept across restarts, intra-/inter-op threads and IO binding of torch
+# tensors, outputs written into preallocated buffers
+
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.general import LOGGER, colorstr
+from utils.optimize import cache_key
+
+ORT_TYPES = {'tensor(float)': torch.float32, 'tensor(float16)': torch.float16}
+
+
+def ort_session(w, providers, cache_dir=None, threads=(0, 0)):
+    # ONNX Runtime session of model w with all graph optimizations and (intra-op, inter-op) threads, 0 for defaults
+    # With cache_dir the graph optimized offline (extended level, portable across CPUs) is saved there on first load and
+    # loaded by later starts, which only apply the hardware-specific layout optimizations again
+    import onnxruntime
+
+    opt = onnxruntime.GraphOptimizationLevel
+    if cache_dir:
+        f = Path(cache_dir) / f'{cache_key(w, "|".join((onnxruntime.__version__, *providers)))}.ort.onnx'
+        if not f.exists():  # write then rename, concurrent starts never load a partial file
+            f.parent.mkdir(parents=True, exist_ok=True)
+            tmp = f.with_suffix(f'.{os.getpid()}.tmp')
+            offline = onnxruntime.SessionOptions()
+            offline.graph_optimization_level = opt.ORT_ENABLE_EXTENDED
+            offline.optimized_model_filepath = str(tmp)
+            onnxruntime.InferenceSession(w, offline, providers=providers)
+            os.replace(tmp, f)
+            LOGGER.info(f'{colorstr("ONNX Runtime:")} optimized graph saved to {f}')
+        w = str(f)
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = opt.ORT_ENABLE_ALL
+    options.intra_op_num_threads, options.inter_op_num_threads = threads
+    if threads[1] > 1:  # independent branches of the graph run in parallel
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    return onnxruntime.InferenceSession(w, options, providers=providers)
+
+
+class IOBoundSession:
+    # Callable running an ONNX Runtime session on CPU torch tensors through IO binding: the input is read in place and
+    # outputs are written into torch buffers allocated on the first run of each input shape, per calling thread.
+    # Returned outputs are copies of those buffers, or with copy=False the buffers themselves: zero-copy, but only
+    # valid until the same thread runs the same shape again, callers keeping outputs across calls must clone them
+    # Models exported with a fixed batch size (export.py without --dynamic) run other batch sizes in chunks
+    def __init__(self, session, copy=True):
+        self.session = session
+        self.copy = copy
+        x = session.get_inputs()[0]
+        self.input_name, self.dtype = x.name, ORT_TYPES[x.type]
+        self.batch = x.shape[0] if isinstance(x.shape[0], int) else None  # fixed batch size
+        self.outputs = [(y.name, ORT_TYPES[y.type]) for y in session.get_outputs()]
+        self.local = threading.local()  # this thread's {input shape: (io binding, output buffers)}
+
+    def __call__(self, im):
+        n = len(im)
+        if self.batch is None or n == self.batch:
+            ys = self.run(im)
+            return [y.clone() for y in ys] if self.copy else ys
+        ys = []
+        for x in im.split(self.batch):
+            if len(x) < self.batch:  # zero-padded last chunk
+                x = torch.cat((x, x.new_zeros((self.batch - len(x), *x.shape[1:]))))
+            ys.append([y.clone() for y in self.run(x)])
+        return [torch.cat(y)[:n] for y in zip(*ys)]  # new tensors
+
+    def run(self, im):
+        im = im.to(self.dtype).contiguous()
+        bindings = getattr(self.local, 'bindings', None)
+        if bindings is None:
+            bindings = self.local.bindings = {}
+        io, ys = bindings.get(tuple(im.shape), (None, None))
+        if io is None:
+            io = self.session.io_binding()
+            for name, _ in self.outputs:
+                io.bind_output(name, 'cpu')  # allocated by ONNX Runtime on this first run, output shapes unknown
+        io.bind_input(self.input_name, 'cpu', 0, np.dtype(str(self.dtype)[6:]), tuple(im.shape), im.data_ptr())
+        self.session.run_with_iobinding(io)
+        if ys is None:  # keep the outputs of the first run as buffers of the following ones
+            ys = [torch.from_numpy(y) for y in io.copy_outputs_to_cpu()]
+            for (name, dtype), y in zip(self.outputs, ys):
+                io.bind_output(name, 'cpu', 0, np.dtype(str(dtype)[6:]), tuple(y.shape), y.data_ptr())
+            bindings[tuple(im.shape)] = io, ys
+        return ys
@@ -0,0 +1,122 @@
+# YOLO quantization-aware training: INT8 fake quantization of Conv and RepConvN blocks (and so RepNCSPELAN4)
+# Quantization is simulated as quantize.py / ONNX Runtime applies it: uint8 per-tensor activations at convolution
+# inputs, int8 symmetric per-channel weights of the deployed kernel, i.e. with BatchNorm folded as fuse_conv_and_bn()
+# and RepConvN branches merged as fuse_convs(). BatchNorm statistics are frozen while quantized
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.common import Conv, RepConvN
+
+
+class FakeQuantize(nn.Module):
+    # Per-tensor uint8 fake quantization, range tracked as a moving average of batch min/max while training
+    # ModelEMA averages observed (1 once observed) like range, dividing by it corrects the average for its zero start
+    def __init__(self, momentum=0.01):
+        super().__init__()
+        self.momentum = momentum
+        self.register_buffer('range', torch.zeros(2))  # min, max
+        self.register_buffer('observed', torch.zeros(()))
+
+    def forward(self, x):
+        if self.training:
+            with torch.no_grad():
+                r = torch.stack((x.min(), x.max())).float()
+                self.range.copy_(torch.where(self.observed > 0, self.range.lerp(r, self.momentum), r))
+                self.observed.fill_(1)
+        scale, zero_point = quantization_params(*self.tracked_range())
+        return torch.fake_quantize_per_tensor_affine(x.float(), scale, zero_point, 0, 255).to(x.dtype)
+
+    def tracked_range(self):
+        # min, max corrected for the zero start of EMA averages
+        return self.range.float() / self.observed.float().clamp(min=1e-8)
+
+
+def quantization_params(lo, hi):
+    # uint8 scale and zero point of tensor range lo, hi (tensors), extended to include 0 as ONNX Runtime's
+    lo, hi = lo.clamp(max=0), hi.clamp(min=0)
+    scale = ((hi - lo) / 255).clamp(min=1e-8)
+    return scale, (-lo / scale).round().clamp(0, 255).int()
+
+
+def fake_quantize_weight(w):
+    # Symmetric per output channel int8 fake quantization of convolution weights (-127 to 127 like ONNX Runtime)
+    scale = (w.detach().abs().amax(dim=(1, 2, 3)).float() / 127).clamp(min=1e-8)
+    zero_point = torch.zeros_like(scale, dtype=torch.int32)
+    return torch.fake_quantize_per_channel_affine(w.float(), scale, zero_point, 0, -127, 127).to(w.dtype)
+
+
+def folded_conv(conv, bn):
+    # Weight and bias of Conv2d conv followed by BatchNorm2d bn in eval mode, the result of fuse_conv_and_bn()
+    scale = bn.weight / (bn.running_var + bn.eps).sqrt()
+    b = bn.bias - bn.running_mean * scale
+    if conv.bias is not None:
+        b = b + conv.bias * scale
+    return conv.weight * scale.reshape(-1, 1, 1, 1), b
+
+
+class QATConv(Conv):
+    # Conv with fake-quantized input and BN-folded weights, fused by Model.fuse() into the same quantized graph
+    def forward(self, x):
+        w, b = folded_conv(self.conv, self.bn)
+        return self.act(self._conv_forward(self.input_quant(x), w, b))
+
+    def forward_fuse(self, x):
+        return self.act(self._conv_forward(self.input_quant(x), self.conv.weight, self.conv.bias))
+
+    def _conv_forward(self, x, w, b):
+        c = self.conv
+        return F.conv2d(x, fake_quantize_weight(w), b, c.stride, c.padding, c.dilation, c.groups)
+
+
+class QATRepConvN(RepConvN):
+    # RepConvN run as its merged 3x3 kernel (fuse_convs()) with fake-quantized input and weights, branches train
+    def forward(self, x):
+        w, b = self.get_equivalent_kernel_bias()
+        return self._conv_forward(self.input_quant(x), w, b, self.conv1.conv)
+
+    def forward_fuse(self, x):
+        return self._conv_forward(self.input_quant(x), self.conv.weight, self.conv.bias, self.conv)
+
+    def _conv_forward(self, x, w, b, c):
+        return self.act(F.conv2d(x, fake_quantize_weight(w), b, c.stride, c.padding, c.dilation, c.groups))
+
+
+QAT_MODULES = {Conv: QATConv, RepConvN: QATRepConvN}
+
+
+def prepare_qat(model):
+    # Switch the Conv and RepConvN blocks of a DetectionModel to fake quantization in place, the head (last layer,
+    # DDetect and its DFL) stays in FP32 like quantize.py keeps it. Parameters are unchanged, optimizers stay valid
+    layers = model.model[:-1]
+    branches = {id(x) for m in layers.modules() if isinstance(m, RepConvN) for x in m.modules() if x is not m}
+    n = 0
+    for m in layers.modules():
+        if type(m) in QAT_MODULES and id(m) not in branches and not hasattr(m, 'input_quant'):
+            device = next(m.parameters()).device
+            m.__class__ = QAT_MODULES[type(m)]
+            m.input_quant = FakeQuantize().to(device)
+            n += 1
+    return n
+
+
+def strip_qat(model):
+    # Back to the float Conv and RepConvN blocks, keeping the trained weights, for inference and export. Before fuse()
+    # The learned ranges stay in checkpoints, quantize.py reads them with qat_ranges()
+    for m in model.modules():
+        for base, qat in QAT_MODULES.items():
+            if type(m) is qat:
+                del m.input_quant
+                m.__class__ = base
+    return model
+
+
+def is_qat(model):
+    return any(type(m) in QAT_MODULES.values() for m in model.modules())
+
+
+def qat_ranges(model):
+    # {module name: (min, max)} input ranges learned by the fake-quantized blocks of a model, for INT8 export
+    qat = tuple(QAT_MODULES.values())
+    return {k: tuple(m.input_quant.tracked_range().tolist()) for k, m in model.named_modules() if type(m) in qat}
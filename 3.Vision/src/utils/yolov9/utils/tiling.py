@@ -0,0 +1,125 @@
+# YOLO tiled (sliced) inference for small objects in large images
+# Reference: The Power of Tiling for Small Object Detection (CVPRW 2019)
+
+import numpy as np
+import torch
+import torchvision
+
+from utils.augmentations import letterbox
+from utils.general import non_max_suppression, scale_boxes
+
+
+def tile_starts(length, tile, overlap=0.2):
+    # Start offsets of overlapping windows covering [0, length), the last window flush with the end
+    if length <= tile:
+        return [0]
+    step = max(1, int(tile * (1 - overlap)))
+    return list(range(0, length - tile, step)) + [length - tile]
+
+
+def make_tiles(shape, tile=(640, 640), overlap=0.2):
+    # Return tile windows (x1, y1, x2, y2) covering an image of shape (h, w), tile is (height, width)
+    h, w = shape[:2]
+    th, tw = tile
+    return [(x, y, min(x + tw, w), min(y + th, h))
+            for y in tile_starts(h, th, overlap)
+            for x in tile_starts(w, tw, overlap)]
+
+
+def box_ios(box1, box2, eps=1e-7):
+    # Intersection over the smaller box area (N,4) x (M,4) -> (N,M), xyxy boxes
+    # Matches a box cut at a tile seam with the full box of the same object, where IoU stays low
+    (a1, a2), (b1, b2) = box1.unsqueeze(1).chunk(2, 2), box2.unsqueeze(0).chunk(2, 2)
+    inter = (torch.min(a2, b2) - torch.max(a1, b1)).clamp(0).prod(2)
+    return inter / (torch.min((a2 - a1).prod(2), (b2 - b1).prod(2)) + eps)
+
+
+def weighted_boxes_fusion(det, iou_thres=0.5, agnostic=False):
+    # Fuse overlapping detections (n,6) [xyxy, conf, cls] into confidence-weighted boxes
+    # Boxes are clustered around the most confident remaining box by intersection-over-smaller-area
+    if not len(det):
+        return det
+    det = det[det[:, 4].argsort(descending=True)]
+    match = box_ios(det[:, :4], det[:, :4]) > iou_thres
+    if not agnostic:
+        match &= det[:, 5:6] == det[:, 5]  # same class only
+    free = torch.ones(len(det), dtype=torch.bool, device=det.device)
+    fused = []
+    for i in range(len(det)):
+        if not free[i]:
+            continue
+        members = match[i] & free
+        free &= ~members
+        w = det[members, 4:5]
+        box = (det[members, :4] * w).sum(0) / w.sum()  # confidence-weighted coordinates
+        fused.append(torch.cat((box, det[i, 4:6])))  # keep leader confidence and class
+    return torch.stack(fused)
+
+
+def merge_tile_detections(det, iou_thres=0.45, agnostic=False, method='nms', max_det=1000):
+    # Merge detections from overlapping tiles (n,6) [xyxy, conf, cls] with class-aware NMS or box fusion
+    if not len(det):
+        return det
+    if method == 'wbf':
+        det = weighted_boxes_fusion(det, iou_thres, agnostic)
+        return det[det[:, 4].argsort(descending=True)][:max_det]
+    assert method == 'nms', f'Unknown tile merge method {method}, valid values are nms, wbf'
+    idxs = torch.zeros_like(det[:, 5]) if agnostic else det[:, 5]
+    i = torchvision.ops.batched_nms(det[:, :4], det[:, 4], idxs, iou_thres)
+    return det[i[:max_det]]
+
+
+def _infer(model, letterboxed, shapes, offsets, conf_thres, iou_thres, classes, agnostic, max_det, nms='nms'):
+    # Forward equally sized letterbox() outputs of BGR images, return detections in original image pixels
+    ims, ratio_pads = zip(*((im, (ratio, pad)) for im, ratio, pad in letterboxed))
+    im = np.stack(ims)[..., ::-1].transpose((0, 3, 1, 2))  # BHWC to BCHW, BGR to RGB
+    im = torch.from_numpy(np.ascontiguousarray(im)).to(model.device)
+    im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+    im /= 255  # 0 - 255 to 0.0 - 1.0
+    pred = non_max_suppression(model(im), conf_thres, iou_thres, classes, agnostic, max_det=max_det, method=nms)
+    for det, shape, ratio_pad, (x, y) in zip(pred, shapes, ratio_pads, offsets):
+        det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], shape, ratio_pad)
+        det[:, [0, 2]] += x
+        det[:, [1, 3]] += y
+    return pred
+
+
+def tiled_inference(model,
+                    im0,
+                    tile=640,
+                    overlap=0.2,
+                    batch_size=8,
+                    conf_thres=0.25,
+                    iou_thres=0.45,
+                    classes=None,
+                    agnostic=False,
+                    max_det=1000,
+                    merge='nms',
+                    full_imgsz=None,
+                    nms='nms'):
+    """Sliced inference on one BGR image with a DetectMultiBackend model
+
+    The image is split into overlapping tiles of the model input size (tile should be a multiple of the model stride),
+    tiles are batched through the model, detections are mapped back to image coordinates and merged across tile seams.
+    An optional low resolution full-image pass (full_imgsz) adds the large objects that tiles cut apart.
+    nms is the suppression within each tile (see utils/nms.py), merge the one across tiles.
+
+    Returns:
+         (n,6) tensor [xyxy, conf, cls] in im0 pixels
+    """
+    tile = (tile, tile) if isinstance(tile, int) else tuple(tile)
+    windows = make_tiles(im0.shape, tile, overlap)
+    dets = []
+    for i in range(0, len(windows), batch_size):
+        chunk = windows[i:i + batch_size]
+        crops = [im0[y1:y2, x1:x2] for x1, y1, x2, y2 in chunk]
+        ims = [letterbox(crop, tile, auto=False, scaleup=False) for crop in crops]  # pad small images
+        dets += _infer(model, ims, [c.shape for c in crops], [w[:2] for w in chunk],
+                       conf_thres, iou_thres, classes, agnostic, max_det, nms)
+
+    if full_imgsz:  # low resolution pass over the whole image
+        full_imgsz = (full_imgsz, full_imgsz) if isinstance(full_imgsz, int) else tuple(full_imgsz)
+        im = letterbox(im0, full_imgsz, stride=model.stride, auto=False)
+        dets += _infer(model, [im], [im0.shape], [(0, 0)], conf_thres, iou_thres, classes, agnostic, max_det, nms)
+
+    return merge_tile_detections(torch.cat(dets), iou_thres, agnostic, merge, max_det)